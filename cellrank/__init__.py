@@ -1,27 +1,66 @@
-from cellrank import pl, models, kernels, logging, datasets, external, estimators
+from typing import TYPE_CHECKING, Any, List
+
+from functools import lru_cache
+from importlib import import_module as _import_module
+
 from cellrank.settings import settings
-from cellrank._utils._lineage import Lineage
+
+if TYPE_CHECKING:
+    from cellrank import pl, models, kernels, logging, datasets, external, estimators
+    from cellrank._utils._lineage import Lineage
 
 __author__ = ", ".join(["Marius Lange", "Michal Klein", "Philipp Weiler"])
 __maintainer__ = ", ".join(["Marius Lange", "Michal Klein", "Philipp Weiler"])
 __version__ = "1.5.1"
 __email__ = "info@cellrank.org"
 
-try:
-    from importlib_metadata import version  # Python < 3.8
-except ImportError:
-    from importlib.metadata import version  # Python = 3.8
 
-from packaging.version import parse
+@lru_cache(maxsize=None)
+def _full_version() -> str:
+    # querying the package metadata is slow, only do it when needed
+    try:
+        from importlib_metadata import version  # Python < 3.8
+    except ImportError:
+        from importlib.metadata import version  # Python = 3.8
+
+    from packaging.version import parse
+
+    try:
+        full_version = parse(version(__name__))
+    except ImportError:
+        return __version__
+
+    return f"{__version__}+{full_version.local}" if full_version.local else __version__
+
+
+# submodules and objects which are only imported on first access
+_lazy = {
+    "pl": "cellrank.pl",
+    "models": "cellrank.models",
+    "kernels": "cellrank.kernels",
+    "logging": "cellrank.logging",
+    "datasets": "cellrank.datasets",
+    "external": "cellrank.external",
+    "estimators": "cellrank.estimators",
+    "Lineage": "cellrank._utils._lineage",
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name == "__full_version__":
+        return _full_version()
+    try:
+        module = _import_module(_lazy[name])
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    obj = getattr(module, name) if name == "Lineage" else module
+    globals()[name] = obj
+
+    return obj
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(_lazy) | {"__full_version__"})
 
-try:
-    __full_version__ = parse(version(__name__))
-    __full_version__ = (
-        f"{__version__}+{__full_version__.local}"
-        if __full_version__.local
-        else __version__
-    )
-except ImportError:
-    __full_version__ = __version__
 
-del version, parse
+del TYPE_CHECKING, Any, List, lru_cache
@@ -1,5 +1,6 @@
 from typing import (
     Any,
+    Dict,
     List,
     Tuple,
     Union,
@@ -17,7 +18,6 @@ from types import FunctionType, MappingProxyType
 from inspect import signature
 from pathlib import Path
 from functools import wraps
-from itertools import combinations
 
 from anndata import AnnData
 from cellrank import logging as logg
@@ -34,6 +34,7 @@ from anndata._io.specs.registry import _REGISTRY, IOSpec
 
 import numpy as np
 import pandas as pd
+from numba import njit, prange
 from scipy.stats import entropy
 from pandas.api.types import infer_dtype, is_categorical_dtype
 
@@ -48,6 +49,7 @@ _HT_CELLS = 10  # head and tail cells to show
 _HTML_REPR_THRESH = 100
 _DUMMY_CELL = "<td style='text-align: right;'>...</td>"
 _ORDER = "C"
+_jit_kwargs = {"nogil": True, "cache": True, "fastmath": True}
 
 
 class PrimingDegree(ModeEnum):  # noqa: D101
@@ -84,6 +86,37 @@ def _at_least_2d(array: np.ndarray, dim: int):
     return np.expand_dims(array, dim) if array.ndim < 2 else array
 
 
+def _is_identity(ixs: Union[range, slice, Any], n: int) -> bool:
+    # whether the indices select all `n` elements in their original order
+    if isinstance(ixs, slice):
+        return ixs.indices(n) == (0, n, 1)
+    return isinstance(ixs, range) and ixs == range(n)
+
+
+def _index_names(names: np.ndarray) -> Dict[str, int]:
+    # `.tolist()` avoids creating a numpy scalar for each name
+    return dict(zip(names.tolist(), range(len(names))))
+
+
+class _LineageAnnotations:
+    """Names, colors and lookups derived from them, shared by lineages with the same columns."""
+
+    __slots__ = ("names", "colors", "names_to_ixs", "mixer_cache")
+
+    def __init__(
+        self,
+        names: Optional[np.ndarray] = None,
+        colors: Optional[np.ndarray] = None,
+        names_to_ixs: Optional[Dict[str, int]] = None,
+    ):
+        if names_to_ixs is None and names is not None:
+            names_to_ixs = _index_names(names)
+        self.names = names
+        self.colors = colors
+        self.names_to_ixs = names_to_ixs
+        self.mixer_cache: Dict[Tuple[int, ...], Tuple[str, str]] = {}
+
+
 def wrap(numpy_func: Callable) -> Callable:
     """
     Wrap an numpy function.
@@ -284,19 +317,16 @@ class Lineage(np.ndarray, metaclass=LineageMeta):
         if obj is None:
             return
 
-        _names = getattr(obj, "_names", None)
-        if _names is not None:
-            self._names = _names
-            self._n_lineages = len(_names)
-            self._names_to_ixs = {n: i for i, n in enumerate(self.names)}
+        # the annotations are shared, they're never modified in-place
+        meta = getattr(obj, "_meta", None)
+        self._meta = _LineageAnnotations() if meta is None else meta
+        if self._meta.names is not None:
+            self._n_lineages = len(self._meta.names)
         else:
-            self._names = None
-            self._names_to_ixs = None
             self._n_lineages = getattr(
                 obj, "_n_lineages", obj.shape[1] if obj.ndim == 2 else 0
             )
 
-        self._colors = getattr(obj, "colors", None)
         self._is_transposed = getattr(obj, "_is_transposed", False)
 
     def __array_function__(self, func, types, args, kwargs):
@@ -337,23 +367,38 @@ class Lineage(np.ndarray, metaclass=LineageMeta):
         ]
         keys = _unique_order_preserving(keys)
 
-        # check the `keys` are unique
-        overlap = [set(ks) for ks in keys]
-        for c1, c2 in combinations(overlap, 2):
-            overlap = c1 & c2
-            if overlap:
-                raise ValueError(
-                    f"Found overlapping keys: `{self.names[list(overlap)]}`."
+        # check the `keys` are unique by counting in how many keys each lineage occurs
+        counts = np.zeros(self._n_lineages, dtype=np.int32)
+        for ks in keys:
+            counts[list(set(ks))] += 1
+        overlap = np.where(counts > 1)[0]
+        if overlap.size:
+            raise ValueError(f"Found overlapping keys: `{self.names[overlap]}`.")
+
+        if isinstance(rows, (int, np.integer)):
+            rows = [rows]
+        elif isinstance(rows, tuple):
+            rows = list(rows)
+        # select the rows only once, instead of per mixture
+        X = self.X[rows]
+
+        keys = [list(key) for key in keys if key]
+        names, colors = [], []
+        res = np.empty((X.shape[0], len(keys)), dtype=X.dtype)
+        for i, key in enumerate(keys):
+            np.sum(X[:, key], axis=1, out=res[:, i])
+
+            cache_key = tuple(key)
+            if cache_key not in self._meta.mixer_cache:
+                self._meta.mixer_cache[cache_key] = (
+                    ", ".join(self.names[key]),
+                    _compute_mean_color(self.colors[key]),
                 )
+            name, color = self._meta.mixer_cache[cache_key]
+            names.append(name)
+            colors.append(color)
 
-        names, colors, res = [], [], []
-        for key in map(list, keys):
-            if key:
-                res.append(self[rows, key].X.sum(1))
-                names.append(", ".join(self.names[key]))
-                colors.append(_compute_mean_color(self.colors[key]))
-
-        return Lineage(np.stack(res, axis=-1), names=names, colors=colors)
+        return Lineage(res, names=names, colors=colors)
 
     def __getitem(self, item):
         if isinstance(item, tuple):
@@ -409,79 +454,48 @@ class Lineage(np.ndarray, metaclass=LineageMeta):
                     item = (slice(None, None, None), self._maybe_convert_names(item))
                     col = item[1]
 
-        shape, row_order, col_order = None, None, None
         if (
             is_tuple_len_2
             and not isinstance(item[0], slice)
             and not isinstance(item[1], slice)
         ):
-            item_0 = (
-                np.array(item[0]) if not isinstance(item[0], np.ndarray) else item[0]
-            )
-            item_1 = (
-                np.array(item[1]) if not isinstance(item[1], np.ndarray) else item[1]
-            )
-            item_0 = _at_least_2d(item_0, -1)
-            item_1 = _at_least_2d(item_1, 0)
-
-            # handle boolean indexing
-            if item_1.dtype == bool:
-                if item_0.dtype != bool:
-                    if not issubclass(item_0.dtype.type, np.integer):
-                        raise TypeError(f"Invalid type `{item_0.dtype.type}`.")
-                    row_order = (
-                        item_0[:, 0]
-                        if item_0.shape[0] == self.shape[0]
-                        else np.argsort(np.argsort(item_0[:, 0]))
-                    )
-                    item_0 = _at_least_2d(np.isin(np.arange(self.shape[0]), item_0), -1)
-                item = item_0 * item_1
-                shape = np.max(np.sum(item, axis=0)), np.max(np.sum(item, axis=1))
-                col = np.where(np.all(item_1, axis=0))[0]
-            elif item_0.dtype == bool:
-                if item_1.dtype != bool:
-                    if not issubclass(item_1.dtype.type, np.integer):
-                        raise TypeError(f"Invalid type `{item_1.dtype.type}`.")
-                    col_order = (
-                        item_1[0, :]
-                        if item_1.shape[1] == self.shape[1]
-                        else np.argsort(np.argsort(item_1[0, :]))
-                    )
-                    item_1 = _at_least_2d(np.isin(np.arange(self.shape[1]), item_1), 0)
-
-                item = item_0 * item_1
-                shape = np.max(np.sum(item, axis=0)), np.max(np.sum(item, axis=1))
-                col = np.where(np.all(item_1, axis=0))[0]
+            item_0 = np.atleast_1d(item[0])
+            item_1 = np.atleast_1d(item[1])
+            if item_0.ndim == 1 and item_1.ndim == 1:
+                for ixs, size in zip((item_0, item_1), self.shape):
+                    if ixs.dtype == bool:
+                        if ixs.shape[0] != size:
+                            raise IndexError(
+                                f"Boolean index has wrong length `{ixs.shape[0]}` instead of `{size}`."
+                            )
+                    elif not issubclass(ixs.dtype.type, np.integer):
+                        raise TypeError(f"Invalid type `{ixs.dtype.type}`.")
+                # outer indexing, without materializing the full boolean mask
+                item = np.ix_(item_0, item_1)
+                col = item[1][0]
             else:
                 # defer to numpy
-                item = (item_0, item_1)
+                item = (_at_least_2d(item_0, -1), _at_least_2d(item_1, 0))
 
         obj = super().__getitem__(item)
 
-        # keep the resulting shape
-        if shape is not None:
-            obj = obj.reshape(shape)
-        # correctly reorder
-        if row_order is not None:
-            obj = obj[row_order, :]
-        if col_order is not None:
-            obj = obj[:, col_order]
-
         # correctly set names and colors
         if isinstance(obj, Lineage):
-            obj._names = np.atleast_1d(self.names[col])
-            obj._colors = np.atleast_1d(self.colors[col])
-            if col_order is not None:
-                obj._names = obj._names[col_order]
-                obj._colors = obj._colors[col_order]
-            obj._names_to_ixs = {name: i for i, name in enumerate(obj._names)}
+            if _is_identity(col, len(self.names)):
+                # only the rows have been selected, the names have already been validated
+                obj._meta = self._meta
+                return obj
+
+            obj._meta = _LineageAnnotations(
+                np.atleast_1d(self.names[col]), np.atleast_1d(self.colors[col])
+            )
 
         return obj
 
     @property
     def names(self) -> np.ndarray:
         """Lineage names. Must be unique."""
-        return self._names
+        return self._meta.names
 
     @names.setter
     def names(self, value: Iterable[str]) -> None:
@@ -494,13 +508,12 @@ class Lineage(np.ndarray, metaclass=LineageMeta):
         if len(set(value)) != len(value):
             raise ValueError(f"Not all lineage names are unique: `{value}`.")
 
-        self._names = self._prepare_annotation(value)
-        self._names_to_ixs = {name: ix for ix, name in enumerate(self.names)}
+        self._meta = _LineageAnnotations(self._prepare_annotation(value), self.colors)
 
     @property
     def colors(self) -> np.ndarray:
         """Lineage colors."""
-        return self._colors
+        return self._meta.colors
 
     @colors.setter
     def colors(self, value: Optional[Iterable[ColorLike]]) -> None:
@@ -510,12 +523,13 @@ class Lineage(np.ndarray, metaclass=LineageMeta):
             raise TypeError(_ERROR_NOT_ITERABLE.format("colors", type(value).__name__))
 
         value = self._check_axis1_shape(value, _ERROR_WRONG_SIZE.format("colors"))
-        self._colors = self._prepare_annotation(
+        value = self._prepare_annotation(
             value,
             checker=c.is_color_like,
             transformer=c.to_hex,
             checker_msg="Value `{}` is not a valid color.",
         )
+        self._meta = _LineageAnnotations(self.names, value, self._meta.names_to_ixs)
 
     @property
     def X(self) -> np.ndarray:
@@ -661,7 +675,7 @@ class Lineage(np.ndarray, metaclass=LineageMeta):
         if len(autotexts):
             autotexts = autotexts[0]
             for name, at in zip(self.names, autotexts):
-                ix = self._names_to_ixs[name]
+                ix = self._meta.names_to_ixs[name]
                 at.set_color(_get_bg_fg_colors(self.colors[ix])[1])
                 if not autopct_found:
                     at.set_text(f"{reduction[ix]:.4f}")
@@ -748,7 +762,7 @@ class Lineage(np.ndarray, metaclass=LineageMeta):
             raise ValueError("Unable to perform the reduction, no keys specified.")
 
         # check the lineage object
-        if not np.allclose(np.sum(self, axis=1).X, 1.0):
+        if not _rows_sum_to_one(self.X):
             raise ValueError("Memberships do not sum to one row-wise.")
 
         if len(keys) == 1:
@@ -766,29 +780,34 @@ class Lineage(np.ndarray, metaclass=LineageMeta):
             )
 
         reference = self[:, keys]
-        rest = [k for k in self.names if all(k not in rk for rk in reference.names)]
-        if not rest:
+        # lineages used by the reference, possibly as part of a mixture, e.g. `"foo, bar"`
+        used = set(reference.names)
+        used.update(name.strip(" ") for rk in reference.names for name in rk.split(","))
+        rest_mask = ~np.isin(self.names, list(used))
+        if not rest_mask.any():
             logg.warning(
                 "Unable to perform reduction because all keys have been selected. Returning combined object only"
             )
             return (reference.copy(), None) if return_weights else reference.copy()
 
-        query = self[:, rest]
+        # from now on, only work with the raw arrays, `X` is a view of the reference
+        X = reference.X
+        query = self.X[:, rest_mask]
 
         if mode == Reduction.SCALE:
-            reference = _row_normalize(reference)
+            X[:] = _row_normalize(X)
         elif mode == Reduction.DIST:
             # compute a set of weights of shape (n_query x n_reference)
             if dist_measure == DistanceMeasure.COSINE_SIM:
-                weights = _cosine_sim(reference.X, query.X)
+                weights = _cosine_sim(X, query)
             elif dist_measure == DistanceMeasure.WASSERSTEIN_DIST:
-                weights = _wasserstein_dist(reference.X, query.X)
+                weights = _wasserstein_dist(X, query)
             elif dist_measure == DistanceMeasure.KL_DIV:
-                weights = _kl_div(reference.X, query.X)
+                weights = _kl_div(X, query)
             elif dist_measure == DistanceMeasure.JS_DIV:
-                weights = _js_div(reference.X, query.X)
+                weights = _js_div(X, query)
             elif dist_measure == DistanceMeasure.MUTUAL_INFO:
-                weights = _mutual_info(reference.X, query.X)
+                weights = _mutual_info(X, query)
             elif dist_measure == DistanceMeasure.EQUAL:
                 weights = _row_normalize(np.ones((query.shape[1], reference.shape[1])))
             else:
@@ -816,26 +835,25 @@ class Lineage(np.ndarray, metaclass=LineageMeta):
             if normalize_weights == NormWeights.SCALE:
                 weights_n = _row_normalize(weights)
             elif normalize_weights == NormWeights.SOFTMAX:
-                weights_n = _softmax(_row_normalize(weights), softmax_scale)
+                weights_n = _softmax(weights, softmax_scale, normalize=True)
             else:
                 raise NotImplementedError(
                     f"Normalization method `{normalize_weights}` is yet implemented."
                 )
 
             # check that the weights row-sum to one now
-            if not np.allclose(weights_n.sum(1), 1.0):
+            if not _rows_sum_to_one(weights_n):
                 raise ValueError("Weights do not sum to 1 row-wise.")
 
             # use the weights to re-distribute probability mass form query to reference
-            for i, w in enumerate(weights_n):
-                reference += np.dot(query[:, i].X, w[None, :])
+            X += query @ weights_n
         else:
             raise NotImplementedError(
                 f"Reduction mode `{mode}` is not yet implemented."
             )
 
         # check that the lineages row-sum to one now
-        if not np.allclose(reference.sum(1), 1.0):
+        if not _rows_sum_to_one(X):
             raise ValueError("Reduced lineage rows do not sum to 1.")
 
         # potentially create a weights-df and return everything
@@ -844,7 +862,9 @@ class Lineage(np.ndarray, metaclass=LineageMeta):
                 return (
                     reference,
                     pd.DataFrame(
-                        data=weights_n, columns=reference.names, index=query.names
+                        data=weights_n,
+                        columns=reference.names,
+                        index=self.names[rest_mask],
                     ),
                 )
             return reference, None
@@ -1029,16 +1049,16 @@ class Lineage(np.ndarray, metaclass=LineageMeta):
         names = names[-1]
         colors = colors[-1]
 
-        self._names = np.empty(names[1])
-        self._colors = np.empty(colors[1])
+        _names = np.empty(names[1])
+        _colors = np.empty(colors[1])
 
         super().__setstate__(tuple(state))
-        self._names.__setstate__(tuple(names))
-        self._colors.__setstate__(tuple(colors))
+        _names.__setstate__(tuple(names))
+        _colors.__setstate__(tuple(colors))
 
+        self._meta = _LineageAnnotations(_names, _colors)
         self._is_transposed = is_t
         self._n_lineages = len(self.names)
-        self._names_to_ixs = {name: ix for ix, name in enumerate(self.names)}
 
     def __reduce__(self):
         res = list(super().__reduce__())
@@ -1083,19 +1103,22 @@ class Lineage(np.ndarray, metaclass=LineageMeta):
 
         if all(isinstance(n, (bool, np.bool_)) for n in names):
             return list(names)
+        if all(isinstance(n, (int, np.integer)) for n in names):
+            res = _unique_order_preserving(names) if make_unique else list(names)
+            return res[0] if is_singleton else res
         res = []
         for name in names:
             if isinstance(name, str):
-                if name in self._names_to_ixs:
-                    name = self._names_to_ixs[name]
+                if name in self._meta.names_to_ixs:
+                    name = self._meta.names_to_ixs[name]
                 elif default is not None:
                     if isinstance(default, str):
-                        if default not in self._names_to_ixs:
+                        if default not in self._meta.names_to_ixs:
                             raise KeyError(
                                 f"Invalid lineage name: `{name}`. "
                                 f"Valid names are: `{list(self.names)}`."
                             )
-                        name = self._names_to_ixs[default]
+                        name = self._meta.names_to_ixs[default]
                     else:
                         name = default
                 else:
@@ -1139,10 +1162,8 @@ class LineageView(Lineage):
 
         view = np.array(lineage, copy=False).view(cls)
         view._owner = lineage
-        view._names = lineage.names
+        view._meta = lineage._meta
         view._n_lineages = len(view.names)
-        view._names_to_ixs = lineage._names_to_ixs
-        view._colors = lineage.colors
         view._is_transposed = lineage._is_transposed
 
         return view
@@ -1189,13 +1210,29 @@ class LineageView(Lineage):
         return obj.T if was_trasposed else obj
 
 
+@njit(parallel=True, **_jit_kwargs)
+def _nonzero_rows(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # single pass over both arrays, stopping at the first zero in a row
+    mask = np.ones(a.shape[0], dtype=np.bool_)
+    for i in prange(a.shape[0]):
+        for j in range(a.shape[1]):
+            if a[i, j] == 0:
+                mask[i] = False
+                break
+        if mask[i]:
+            for j in range(b.shape[1]):
+                if b[i, j] == 0:
+                    mask[i] = False
+                    break
+
+    return mask
+
+
 def _remove_zero_rows(a: np.ndarray, b: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
     if a.shape[0] != b.shape[0]:
         raise ValueError("Lineage objects have unequal cell numbers")
 
-    bool_a = (a == 0).any(axis=1)
-    bool_b = (b == 0).any(axis=1)
-    mask = ~np.logical_or(bool_a, bool_b)
+    mask = _nonzero_rows(np.asarray(a), np.asarray(b))
 
     logg.warning(
         f"Removed {a.shape[0] - np.sum(mask)} rows because they contained zeros"
@@ -1204,8 +1241,25 @@ def _remove_zero_rows(a: np.ndarray, b: np.ndarray) -> Tuple[np.ndarray, np.ndar
     return a[mask, :], b[mask, :]
 
 
-def _softmax(X, beta: float = 1):
-    return np.exp(X * beta) / np.expand_dims(np.sum(np.exp(X * beta), axis=1), -1)
+def _rows_sum_to_one(X: np.ndarray, rtol: float = 1e-5, atol: float = 1e-8) -> bool:
+    # same as `np.allclose(X.sum(1), 1.0)`, without the temporaries
+    sums = np.asarray(X).sum(axis=1, dtype=np.float64)
+    sums -= 1.0
+    np.abs(sums, out=sums)
+    return bool(sums.max() <= atol + rtol)
+
+
+def _softmax(X, beta: float = 1, normalize: bool = False):
+    if normalize:
+        # row-normalize and scale in the same pass
+        beta = beta / np.sum(X, axis=1, keepdims=True, dtype=np.float64)
+    Z = np.multiply(X, beta, dtype=np.float64)
+    # subtract the row-wise maximum for numerical stability
+    Z -= Z.max(axis=1, keepdims=True)
+    np.exp(Z, out=Z)
+    Z /= Z.sum(axis=1, keepdims=True)
+
+    return Z
 
 
 def _row_normalize(X):
@@ -1229,45 +1283,88 @@ def _cosine_sim(reference, query):
     return (reference_n.T @ query_n).T
 
 
+def _as_distributions(X: np.ndarray) -> np.ndarray:
+    # store each column as a contiguous row, normalized to be a valid probability distribution
+    X = np.array(X.T, dtype=np.float64, order="C")
+    X /= np.linalg.norm(X, ord=1, axis=1, keepdims=True)
+
+    return X
+
+
 def _point_wise_distance(reference, query, distance):
     # utility function for all point-wise distances/divergences
     # take care of rows that contain zeros
     reference_no_zero, query_no_zero = _remove_zero_rows(reference, query)
 
-    # normalize these to be valid probability distributions (column-wise)
-    reference_n, query_n = (
-        _col_normalize(reference_no_zero, 1),
-        _col_normalize(query_no_zero, 1),
+    # normalize only once, `distance` gets the states as rows
+    # and computes all pairwise distances between the query and reference states
+    weights = distance(
+        _as_distributions(reference_no_zero), _as_distributions(query_no_zero)
     )
+    np.reciprocal(weights, out=weights)
 
-    # loop over query and reference columns and compute pairwise wasserstein distances
-    weights = np.zeros((query.shape[1], reference.shape[1]))
-    for i, q_d in enumerate(query_n.T):
-        for j, r_d in enumerate(reference_n.T):
-            weights[i, j] = 1.0 / distance(q_d, r_d)
+    return weights
+
+
+@njit(parallel=True, **_jit_kwargs)
+def _wasserstein_dist_numba(reference: np.ndarray, query: np.ndarray) -> np.ndarray:
+    # rows are sorted samples of equal size
+    n = query.shape[1]
+    weights = np.empty((query.shape[0], reference.shape[0]))
+    for i in prange(query.shape[0]):
+        for j in range(reference.shape[0]):
+            acc = 0.0
+            for k in range(n):
+                acc += np.abs(query[i, k] - reference[j, k])
+            weights[i, j] = acc / n
+
+    return weights
+
+
+@njit(parallel=True, **_jit_kwargs)
+def _js_div_numba(reference: np.ndarray, query: np.ndarray) -> np.ndarray:
+    # rows are strictly positive probability distributions
+    weights = np.empty((query.shape[0], reference.shape[0]))
+    for i in prange(query.shape[0]):
+        for j in range(reference.shape[0]):
+            acc = 0.0
+            for k in range(query.shape[1]):
+                q, r = query[i, k], reference[j, k]
+                m = (q + r) / 2.0
+                acc += q * np.log(q / m) + r * np.log(r / m)
+            weights[i, j] = np.sqrt(acc / 2.0)
 
     return weights
 
 
 def _wasserstein_dist(reference, query):
     # the wasserstein distance is symmetric
-    from scipy.stats import wasserstein_distance
 
-    return _point_wise_distance(reference, query, wasserstein_distance)
+    def distance(reference: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # for samples of equal size, the 1-D wasserstein distance is the mean absolute difference
+        # of the sorted samples, i.e. each state is only sorted once
+        reference.sort(axis=1)
+        query.sort(axis=1)
+        return _wasserstein_dist_numba(reference, query)
+
+    return _point_wise_distance(reference, query, distance)
 
 
 def _kl_div(reference, query):
     # the KL divergence is not symmetric
-    from scipy.stats import entropy
 
-    return _point_wise_distance(reference, query, entropy)
+    def distance(reference: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # KL(q || r) = sum(q * log(q)) - sum(q * log(r)), all pairs at once
+        return np.sum(query * np.log(query), axis=1)[:, None] - query @ np.log(
+            reference.T
+        )
+
+    return _point_wise_distance(reference, query, distance)
 
 
 def _js_div(reference, query):
     # the js divergence is symmetric
-    from scipy.spatial.distance import jensenshannon
-
-    return _point_wise_distance(reference, query, jensenshannon)
+    return _point_wise_distance(reference, query, _js_div_numba)
 
 
 def _mutual_info(reference, query):
@@ -1110,8 +1110,7 @@ def _merge_categorical_series(
 
 def _unique_order_preserving(iterable: Iterable[Hashable]) -> List[Hashable]:
     """Remove items from an iterable while preserving the order."""
-    seen = set()
-    return [i for i in iterable if i not in seen and not seen.add(i)]
+    return list(dict.fromkeys(iterable))
 
 
 def _info_if_obs_keys_categorical_present(
@@ -1723,9 +1722,11 @@ def valuedispatch(func):
 
 def _densify_squeeze(x: Union[spmatrix, np.ndarray], dtype=np.float32) -> np.ndarray:
     if issparse(x):
-        x = x.toarray()
-    # use np.array instead of asarray to create a copy
-    x = np.array(x, dtype=dtype)
+        # `.toarray()` already creates a copy
+        x = x.toarray().astype(dtype, copy=False)
+    else:
+        # use np.array instead of asarray to create a copy
+        x = np.array(x, dtype=dtype)
     if x.ndim == 2 and x.shape[1] == 1:
         x = np.squeeze(x, axis=1)
 
@@ -3,6 +3,7 @@ from cellrank.datasets._datasets import (
     pancreas,
     zebrafish,
     bone_marrow,
+    clear_cache,
     reprogramming_morris,
     pancreas_preprocessed,
     reprogramming_schiebinger,
@@ -1,15 +1,19 @@
-from typing import Any, Tuple, Union
+from typing import Any, Tuple, Union, Mapping, Hashable, Optional, NamedTuple
 from typing_extensions import Literal
 
 import os
-from enum import auto
+import h5py
+from types import MappingProxyType
 from pathlib import Path
+from weakref import WeakValueDictionary
 
 from scanpy import read
 from anndata import AnnData
 from cellrank import logging as logg
-from cellrank._utils._docs import d, inject_docs
-from cellrank._utils._enum import ModeEnum
+from cellrank._utils._docs import d
+from cellrank.datasets._download import _download
+
+import pandas as pd
 
 __all__ = (
     "pancreas",
@@ -19,60 +23,193 @@ __all__ = (
     "reprogramming_schiebinger",
     "zebrafish",
     "bone_marrow",
+    "clear_cache",
 )
 
 
-class ReprogrammingSubset(ModeEnum):
-    FULL = auto()
-    K48 = "48k"
-    K85 = "85k"
+class _Dataset(NamedTuple):
+    url: str
+    shape: Tuple[int, int]
 
 
 # fmt: off
-_datasets = {
-    "pancreas": ("https://figshare.com/ndownloader/files/25060877", (2531, 27998)),
-    "pancreas_preprocessed": ("https://figshare.com/ndownloader/files/25030028", (2531, 2000)),
-    "lung": ("https://figshare.com/ndownloader/files/25038224", (24882, 24051)),
-    "reprogramming_morris": ("https://figshare.com/ndownloader/files/25503773", (104679, 22630)),
-    "zebrafish": ("https://figshare.com/ndownloader/files/27265280", (2434, 23974)),
-    "reprogramming_schiebinger": ("https://figshare.com/ndownloader/files/28618734", (236285, 19089)),
-    "reprogramming_schiebinger_serum_subset": ("https://figshare.com/ndownloader/files/35858033", (165892, 19089)),
-    "bone_marrow": ("https://figshare.com/ndownloader/files/35826944", (5780, 27876)),
-}
+_datasets: Mapping[str, _Dataset] = MappingProxyType({
+    "pancreas": _Dataset("https://figshare.com/ndownloader/files/25060877", (2531, 27998)),
+    "pancreas_preprocessed": _Dataset("https://figshare.com/ndownloader/files/25030028", (2531, 2000)),
+    "lung": _Dataset("https://figshare.com/ndownloader/files/25038224", (24882, 24051)),
+    "reprogramming_morris": _Dataset("https://figshare.com/ndownloader/files/25503773", (104679, 22630)),
+    "zebrafish": _Dataset("https://figshare.com/ndownloader/files/27265280", (2434, 23974)),
+    "reprogramming_schiebinger": _Dataset("https://figshare.com/ndownloader/files/28618734", (236285, 19089)),
+    "reprogramming_schiebinger_serum_subset": _Dataset(
+        "https://figshare.com/ndownloader/files/35858033", (165892, 19089)
+    ),
+    "bone_marrow": _Dataset("https://figshare.com/ndownloader/files/35826944", (5780, 27876)),
+})
 # fmt: on
 
+# `obs` column whose non-missing values define the subset of `reprogramming_morris`
+_reprogramming_subsets: Mapping[str, Optional[str]] = MappingProxyType(
+    {"full": None, "48k": "cluster", "85k": "timecourse"}
+)
+
+# HDF5's default chunk cache (1 MiB per dataset) is too small for the larger backed datasets,
+# the number of hash table slots should be a prime
+_CHUNK_CACHE_NBYTES = 128 << 20
+_CHUNK_CACHE_NSLOTS = 100003
+
+# only weak references are kept, so that no dataset is held in memory by the cache
+_cache: "WeakValueDictionary[Hashable, AnnData]" = WeakValueDictionary()
+
+
+def clear_cache() -> None:
+    """
+    Clear the cache of already loaded datasets used when ``reuse = True``.
+
+    Returns
+    -------
+    Nothing, just forgets the loaded :class:`anndata.AnnData` objects.
+    """
+    _cache.clear()
+
+
+def _is_lazy(adata: AnnData) -> bool:
+    # lazily loaded objects have e.g. `anndata.experimental.backed.Dataset2D` annotations
+    return not isinstance(adata.obs, pd.DataFrame)
+
+
+def _read_lazy(fpath: Path) -> Optional[AnnData]:
+    try:
+        from anndata.experimental import read_lazy
+    except ImportError:
+        logg.warning(
+            "Installed `anndata` does not support lazy loading. Using `backed='r'` instead"
+        )
+        return None
+
+    # `anndata` opens and owns the file handle
+    return read_lazy(os.fspath(fpath))
+
+
+def _peek_shape(fpath: Path) -> Tuple[int, int]:
+    # only reads the metadata of `X`
+    with h5py.File(fpath, "r") as f:
+        X = f["X"]
+        if isinstance(X, h5py.Dataset):
+            return X.shape
+        # sparse matrices written by older versions of `anndata` use `h5sparse_shape`
+        shape = X.attrs["shape"] if "shape" in X.attrs else X.attrs["h5sparse_shape"]
+        return tuple(int(s) for s in shape)
+
+
+def _set_chunk_cache(adata: AnnData) -> None:
+    # `anndata` doesn't expose the chunk cache, reopen its backing file with a larger one
+    manager = adata.file
+    try:
+        filename, filemode = manager.filename, manager._filemode
+    except AttributeError as e:
+        logg.debug(f"Unable to set the chunk cache. Reason: `{e}`")
+        return
+
+    manager.close()
+    try:
+        manager._file = h5py.File(
+            filename,
+            filemode,
+            rdcc_nbytes=_CHUNK_CACHE_NBYTES,
+            rdcc_nslots=_CHUNK_CACHE_NSLOTS,
+            rdcc_w0=0.75,
+        )
+    except (AttributeError, OSError) as e:
+        logg.debug(
+            f"Unable to set the chunk cache of `{str(filename)!r}`. Reason: `{e}`"
+        )
+        # fall back to the handle opened by `anndata`
+        manager.open(filename, filemode)
+
+
+def _cache_key(
+    fpath: Path, expected_shape: Tuple[int, int], kwargs: Any
+) -> Optional[Hashable]:
+    if kwargs.get("backed", None) not in (None, False):
+        # backed objects are cheap to open and hold a file handle
+        return None
+    try:
+        key = (
+            os.path.realpath(fpath),
+            fpath.stat().st_mtime_ns,
+            expected_shape,
+            tuple(sorted(kwargs.items())),
+        )
+        hash(key)
+    except (OSError, TypeError):
+        return None
+
+    return key
+
 
 def _load_dataset_from_url(
-    fpath: Union[str, Path], url: str, expected_shape: Tuple[int, int], **kwargs: Any
+    fpath: Union[str, Path],
+    dataset: _Dataset,
+    backed: Optional[Literal["r", "r+"]] = None,
+    lazy: bool = False,
+    reuse: bool = False,
+    **kwargs: Any,
 ) -> AnnData:
-    fpath = str(fpath)
-    if not fpath.endswith(".h5ad"):
-        fpath += ".h5ad"
+    fpath = Path(fpath)
+    if fpath.suffix != ".h5ad":
+        fpath = fpath.with_name(fpath.name + ".h5ad")
 
-    if os.path.isfile(fpath):
-        logg.debug(f"Loading dataset from `{fpath!r}`")
-    else:
-        logg.debug(f"Downloading dataset from `{url!r}` as `{fpath!r}`")
-
-    dirname, _ = os.path.split(fpath)
     try:
-        if not os.path.isdir(dirname):
-            logg.debug(f"Creating directory `{dirname!r}`")
-            os.makedirs(dirname, exist_ok=True)
+        fpath.parent.mkdir(parents=True, exist_ok=True)
     except OSError as e:
-        logg.debug(f"Unable to create directory `{dirname!r}`. Reason `{e}`")
+        logg.debug(f"Unable to create directory `{str(fpath.parent)!r}`. Reason `{e}`")
 
+    kwargs.setdefault("backed", backed)
     kwargs.setdefault("sparse", True)
     kwargs.setdefault("cache", True)
 
-    adata = read(fpath, backup_url=url, **kwargs)
+    key = _cache_key(fpath, dataset.shape, kwargs) if reuse and not lazy else None
+    adata = None if key is None else _cache.get(key, None)
+    if adata is not None:
+        logg.debug(f"Reusing already loaded dataset `{str(fpath)!r}`")
+        return adata
 
-    if adata.shape != expected_shape:
+    if not fpath.is_file():
+        _download(dataset.url, fpath)
+        shape = _peek_shape(fpath)
+    else:
+        try:
+            shape = _peek_shape(fpath)
+        except (OSError, KeyError) as e:
+            logg.warning(
+                f"Unable to read `{str(fpath)!r}`. Reason: `{e}`. Downloading it again"
+            )
+            _download(dataset.url, fpath)
+            shape = _peek_shape(fpath)
+
+    # fail before parsing the whole file
+    if shape != dataset.shape:
         raise ValueError(
-            f"Expected `anndata.AnnData` object to have shape `{expected_shape}`, found `{adata.shape}`."
+            f"Expected `anndata.AnnData` object to have shape `{dataset.shape}`, found `{shape}`."
         )
 
-    adata.var_names_make_unique()
+    adata = _read_lazy(fpath) if lazy else None
+    if adata is None:
+        if lazy:
+            kwargs["backed"] = "r"
+        logg.debug(f"Loading dataset from `{str(fpath)!r}`")
+        adata = read(os.fspath(fpath), **kwargs)
+
+    if _is_lazy(adata):
+        return adata
+    if adata.isbacked:
+        _set_chunk_cache(adata)
+    if not adata.var_names.is_unique:
+        adata.var_names_make_unique()
+
+    key = _cache_key(fpath, dataset.shape, kwargs) if reuse else None
+    if key is not None:
+        _cache[key] = adata
 
     return adata
 
@@ -81,6 +218,7 @@ def _load_dataset_from_url(
 @d.dedent
 def pancreas(
     path: Union[str, Path] = "datasets/endocrinogenesis_day15.5.h5ad",
+    reuse: bool = False,
     **kwargs: Any,
 ) -> AnnData:
     """
@@ -96,6 +234,10 @@ def pancreas(
     ----------
     path
         Path where to save the dataset.
+    reuse
+        Whether to return the previously loaded object, as long as it is still referenced, instead of reading
+        the file again. Objects opened in backed mode are never reused. Note that any modifications of the returned
+        object are shared.
     kwargs
         Keyword arguments for :func:`scanpy.read`.
 
@@ -103,12 +245,13 @@ def pancreas(
     -------
     %(adata)s
     """
-    return _load_dataset_from_url(path, *_datasets["pancreas"], **kwargs)
+    return _load_dataset_from_url(path, _datasets["pancreas"], reuse=reuse, **kwargs)
 
 
 @d.dedent
 def pancreas_preprocessed(
     path: Union[str, Path] = "datasets/endocrinogenesis_day15.5_preprocessed.h5ad",
+    reuse: bool = False,
     **kwargs: Any,
 ) -> AnnData:
     """
@@ -123,12 +266,15 @@ def pancreas_preprocessed(
     -------
     %(adata)s
     """
-    return _load_dataset_from_url(path, *_datasets["pancreas_preprocessed"], **kwargs)
+    return _load_dataset_from_url(
+        path, _datasets["pancreas_preprocessed"], reuse=reuse, **kwargs
+    )
 
 
 @d.dedent
 def lung(
     path: Union[str, Path] = "datasets/lung_regeneration.h5ad",
+    reuse: bool = False,
     **kwargs: Any,
 ) -> AnnData:
     """
@@ -150,14 +296,15 @@ def lung(
     -------
     %(adata)s
     """
-    return _load_dataset_from_url(path, *_datasets["lung"], **kwargs)
+    return _load_dataset_from_url(path, _datasets["lung"], reuse=reuse, **kwargs)
 
 
-@inject_docs(s=ReprogrammingSubset)
 @d.dedent
 def reprogramming_morris(
-    subset: Literal["full", "48k", "85k"] = ReprogrammingSubset.FULL,
+    subset: Literal["full", "48k", "85k"] = "full",
     path: Union[str, Path] = "datasets/reprogramming_morris.h5ad",
+    reuse: bool = False,
+    lazy: bool = False,
     **kwargs: Any,
 ) -> AnnData:
     """
@@ -179,11 +326,15 @@ def reprogramming_morris(
     subset
         Whether to return the full object or just a subset. Can be one of:
 
-            - `{s.FULL!r}` - return the complete dataset containing `104 887` cells.
-            - `{s.K85!r}` - return the subset as described in :cite:`morris:18` Fig. 1, containing `85 010` cells.
-            - `{s.K48!r}` - return the subset as described in :cite:`morris:18` Fig. 3, containing `48 515` cells.
+            - `'full'` - return the complete dataset containing `104 887` cells.
+            - `'85k'` - return the subset as described in :cite:`morris:18` Fig. 1, containing `85 010` cells.
+            - `'48k'` - return the subset as described in :cite:`morris:18` Fig. 3, containing `48 515` cells.
 
     %(dataset.parameters)s
+    lazy
+        Whether to load the dataset lazily using :func:`anndata.experimental.read_lazy`. Subsets of lazily loaded
+        datasets are not loaded into memory. If not supported by the installed :mod:`anndata` version,
+        the dataset is opened in backed mode instead.
 
     Returns
     -------
@@ -192,24 +343,50 @@ def reprogramming_morris(
     Notes
     -----
     The dataset has approximately 1.5GiB and the subsetting is performed locally after the full download.
+    By default, the full dataset is opened in backed mode, use ``backed=None`` to load it into memory.
+    Unless the dataset is loaded lazily, subsets are always loaded into memory. To do so, the full dataset
+    is opened read-only in backed mode, any other value of ``backed`` is ignored.
     """
-    subset = ReprogrammingSubset(subset)
-    adata = _load_dataset_from_url(path, *_datasets["reprogramming_morris"], **kwargs)
+    try:
+        key = _reprogramming_subsets[subset]
+    except KeyError:
+        raise ValueError(
+            f"Invalid option `{subset!r}` for `subset`. Valid options are: `{list(_reprogramming_subsets)}`."
+        ) from None
+    backed = kwargs.pop("backed", "r")
+    if key is not None:
+        if backed not in (None, False, "r"):
+            logg.warning(
+                f"Subsets are always loaded into memory, ignoring `backed={backed!r}`"
+            )
+        # in backed mode, `X` stays on disk and only the rows of the subset are read
+        backed = "r"
+    adata = _load_dataset_from_url(
+        path,
+        _datasets["reprogramming_morris"],
+        backed=backed,
+        lazy=lazy,
+        reuse=reuse,
+        **kwargs,
+    )
 
-    if subset == ReprogrammingSubset.FULL:
+    if key is None:
         return adata
-    if subset == ReprogrammingSubset.K48:
-        return adata[~adata.obs["cluster"].isnull()].copy()
-    if subset == ReprogrammingSubset.K85:
-        return adata[~adata.obs["timecourse"].isnull()].copy()
+    # lazy annotations must be loaded before they can be used for indexing
+    obs = adata.obs.to_memory() if _is_lazy(adata) else adata.obs
+    mask = ~obs[key].isnull().to_numpy()
 
-    raise NotImplementedError(f"Subsetting option `{subset!r}` is not yet implemented.")
+    if _is_lazy(adata):
+        return adata[mask]
+    return adata[mask].to_memory()
 
 
 @d.dedent
 def reprogramming_schiebinger(
     path: Union[str, Path] = "datasets/reprogramming_schiebinger.h5ad",
     subset_to_serum: bool = False,
+    reuse: bool = False,
+    lazy: bool = False,
     **kwargs: Any,
 ) -> AnnData:
     """
@@ -232,6 +409,9 @@ def reprogramming_schiebinger(
     subset_to_serum
         Whether to return the full object or subsetted to the serum condition.
         This subset also contains the pre-computed transition matrix.
+    lazy
+        Whether to load the dataset lazily using :func:`anndata.experimental.read_lazy`. If not supported by
+        the installed :mod:`anndata` version, the dataset is opened in backed mode.
 
     Returns
     -------
@@ -239,19 +419,28 @@ def reprogramming_schiebinger(
 
     Notes
     -----
-    The full dataset has approximately 1.4GiB.
+    The full dataset has approximately 1.4GiB. By default, the dataset is opened in backed mode,
+    use ``backed=None`` to load it into memory.
     """
     key = (
         "reprogramming_schiebinger_serum_subset"
         if subset_to_serum
         else "reprogramming_schiebinger"
     )
-    return _load_dataset_from_url(path, *_datasets[key], **kwargs)
+    return _load_dataset_from_url(
+        path,
+        _datasets[key],
+        backed=kwargs.pop("backed", "r"),
+        lazy=lazy,
+        reuse=reuse,
+        **kwargs,
+    )
 
 
 @d.dedent
 def zebrafish(
     path: Union[str, Path] = "datasets/zebrafish.h5ad",
+    reuse: bool = False,
     **kwargs: Any,
 ) -> AnnData:
     """
@@ -268,12 +457,13 @@ def zebrafish(
     -------
     %(adata)s
     """
-    return _load_dataset_from_url(path, *_datasets["zebrafish"], **kwargs)
+    return _load_dataset_from_url(path, _datasets["zebrafish"], reuse=reuse, **kwargs)
 
 
 @d.dedent
 def bone_marrow(
     path: Union[str, Path] = "datasets/bone_marrow.h5ad",
+    reuse: bool = False,
     **kwargs: Any,
 ) -> AnnData:
     """
@@ -290,4 +480,4 @@ def bone_marrow(
     -------
     %(adata)s
     """
-    return _load_dataset_from_url(path, *_datasets["bone_marrow"], **kwargs)
+    return _load_dataset_from_url(path, _datasets["bone_marrow"], reuse=reuse, **kwargs)
@@ -0,0 +1,632 @@
+from typing import Any, List, Tuple, Callable, Optional, Sequence
+
+import os
+import re
+import json
+import zlib
+from time import perf_counter
+from queue import Empty, Queue
+from pathlib import Path
+from threading import Lock, Thread, Condition, local
+from http.client import HTTPException, HTTPConnection, HTTPSConnection
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from urllib.request import Request, urlopen
+
+from cellrank import logging as logg
+
+__all__ = ["_download"]
+
+_USER_AGENT = "cellrank-user"
+_CONTENT_RANGE = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+)")
+_BLOCK_SIZE = 1 << 20
+_TIMEOUT = 60
+
+
+def _probe(url: str) -> Tuple[str, Optional[int]]:
+    """
+    Check whether ``url`` supports range requests.
+
+    Parameters
+    ----------
+    url
+        URL to probe.
+
+    Returns
+    -------
+    The URL after following any redirects and the total size in bytes or `None`, if range requests are not supported.
+    """
+    req = Request(url, headers={"User-Agent": _USER_AGENT, "Range": "bytes=0-0"})
+    with urlopen(req, timeout=_TIMEOUT) as resp:
+        match = _CONTENT_RANGE.fullmatch(resp.headers.get("Content-Range", "").strip())
+        if resp.status != 206 or match is None:
+            return url, None
+        return resp.geturl(), int(match.group(3))
+
+
+def _split(start: int, end: int, chunk: int) -> List[Tuple[int, int]]:
+    """Split ``[start, end)`` into half-open byte ranges of size at most ``chunk``."""
+    return [(pos, min(pos + chunk, end)) for pos in range(start, end, chunk)]
+
+
+class _Journal:
+    """
+    Record which byte ranges of a partial download have already been written, so that it can be resumed.
+
+    Parameters
+    ----------
+    fpath
+        Where to save the journal.
+    url
+        URL being downloaded.
+    total
+        Total size of the file in bytes.
+    """
+
+    def __init__(self, fpath: Path, url: str, total: int):
+        self._fpath = fpath
+        self._url = url
+        self._total = total
+        self._lock = Lock()
+        self._done: List[Tuple[int, int]] = []
+
+    def load(self) -> int:
+        """
+        Load the journal of a previous download of the same URL and size, if it exists.
+
+        Returns
+        -------
+        The number of already downloaded bytes.
+        """
+        try:
+            with open(self._fpath) as fin:
+                data = json.load(fin)
+            if data["url"] != self._url or data["total"] != self._total:
+                return 0
+            self._done = self._merge(
+                [(int(s), int(e)) for s, e in data["complete_ranges"]]
+            )
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            logg.debug(
+                f"Unable to load download journal `{str(self._fpath)!r}`. Reason `{e}`"
+            )
+            self._done = []
+
+        return self.n_bytes
+
+    def add(self, start: int, end: int) -> None:
+        """
+        Mark the byte range ``[start, end)`` as downloaded.
+
+        Parameters
+        ----------
+        start
+            First byte of the range.
+        end
+            Byte after the last byte of the range.
+
+        Returns
+        -------
+        Nothing, just updates the journal on disk.
+        """
+        with self._lock:
+            self._done = self._merge(self._done + [(start, end)])
+            data = {
+                "url": self._url,
+                "total": self._total,
+                "complete_ranges": self._done,
+            }
+            tmp = self._fpath.with_name(self._fpath.name + ".tmp")
+            with open(tmp, "w") as fout:
+                json.dump(data, fout)
+            os.replace(tmp, self._fpath)
+
+    def missing(self, chunk: int) -> List[Tuple[int, int]]:
+        """
+        Split the not yet downloaded bytes into ranges.
+
+        Parameters
+        ----------
+        chunk
+            Maximum size of a range in bytes.
+
+        Returns
+        -------
+        The missing half-open byte ranges.
+        """
+        ranges, pos = [], 0
+        for start, end in self._done + [(self._total, self._total)]:
+            ranges.extend(_split(pos, start, chunk))
+            pos = end
+        return ranges
+
+    def remove(self) -> None:
+        """Remove the journal from disk."""
+        if self._fpath.is_file():
+            self._fpath.unlink()
+
+    @property
+    def n_bytes(self) -> int:
+        """Number of downloaded bytes."""
+        return sum(end - start for start, end in self._done)
+
+    @staticmethod
+    def _merge(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        merged: List[Tuple[int, int]] = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+
+class _RangeFetcher:
+    """
+    Download byte ranges of a URL over persistent connections, one per thread.
+
+    Failed ranges are retried. Since the URL is usually a redirect to a short-lived signed URL, client errors
+    cause the redirect to be resolved again before retrying.
+
+    Parameters
+    ----------
+    url
+        URL to download from.
+    fpath
+        Preallocated file where to write the data.
+    retries
+        Number of times to retry a failed range.
+    """
+
+    def __init__(self, url: str, fpath: Path, retries: int = 3):
+        self._url = url
+        self._target = url
+        self._fpath = fpath
+        self._retries = retries
+        self._lock = Lock()
+        self._local = local()
+        self._connections: List[HTTPConnection] = []
+
+    def resolve(self) -> Optional[int]:
+        """
+        Resolve the redirects of the URL.
+
+        Returns
+        -------
+        The total size in bytes or `None`, if range requests are not supported.
+        """
+        target, total = _probe(self._url)
+        self._target = target
+        return total
+
+    def __call__(self, start: int, end: int) -> int:
+        """
+        Download the byte range ``[start, end)`` into the same offsets of the file.
+
+        Parameters
+        ----------
+        start
+            First byte of the range.
+        end
+            Byte after the last byte of the range.
+
+        Returns
+        -------
+        The number of written bytes.
+        """
+        for attempt in range(self._retries + 1):
+            target = self._target
+            try:
+                return self._fetch(target, start, end)
+            except (OSError, HTTPException) as e:
+                if attempt == self._retries:
+                    raise
+                logg.debug(
+                    f"Unable to download range `{start}-{end - 1}`. Reason `{e}`"
+                )
+                if isinstance(e, HTTPError) and 400 <= e.code < 500:
+                    with self._lock:
+                        # another thread might have already resolved it
+                        if self._target == target:
+                            self.resolve()
+                else:
+                    self._reset()
+
+        raise AssertionError("Unreachable.")
+
+    def close(self) -> None:
+        """Close all connections."""
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    def _connection(self, scheme: str, netloc: str) -> HTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.key == (scheme, netloc):
+            return conn
+
+        self._reset()
+        conn = (HTTPSConnection if scheme == "https" else HTTPConnection)(
+            netloc, timeout=_TIMEOUT
+        )
+        self._local.conn, self._local.key = conn, (scheme, netloc)
+        with self._lock:
+            self._connections.append(conn)
+
+        return conn
+
+    def _reset(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        conn.close()
+        self._local.conn = None
+        with self._lock:
+            self._connections.remove(conn)
+
+    def _fetch(self, target: str, start: int, end: int) -> int:
+        parts = urlsplit(target)
+        conn = self._connection(parts.scheme, parts.netloc)
+        path = (
+            f"{parts.path or '/'}?{parts.query}" if parts.query else parts.path or "/"
+        )
+        conn.request(
+            "GET",
+            path,
+            headers={"User-Agent": _USER_AGENT, "Range": f"bytes={start}-{end - 1}"},
+        )
+        resp = conn.getresponse()
+        if resp.status != 206:
+            # consume the body to be able to reuse the connection
+            resp.read()
+            raise HTTPError(target, resp.status, resp.reason, resp.headers, None)
+
+        written = 0
+        with open(self._fpath, "r+b") as fout:
+            fout.seek(start)
+            while True:
+                block = resp.read(_BLOCK_SIZE)
+                if not block:
+                    break
+                fout.write(block)
+                written += len(block)
+
+        if written != end - start:
+            raise OSError(
+                f"Expected to download `{end - start}` bytes for range `{start}-{end - 1}`, found `{written}`."
+            )
+
+        return written
+
+
+def _progress_bar(total: Optional[int]) -> Any:
+    from tqdm.auto import tqdm
+
+    return tqdm(
+        total=total, unit="B", unit_scale=True, unit_divisor=1024, desc="Downloading"
+    )
+
+
+def _preallocate(fpath: Path, size: int) -> None:
+    with open(fpath, "wb") as fout:
+        try:
+            os.posix_fallocate(fout.fileno(), 0, size)
+        except (AttributeError, OSError):
+            # not available on all platforms/filesystems
+            fout.truncate(size)
+
+
+class _ConcurrencyController:
+    """
+    Download byte ranges while adapting the number of concurrent streams to the measured throughput.
+
+    Workers lazily pull ranges from a shared queue. Every ``window`` completed ranges, the aggregate throughput
+    is compared to the one measured in the previous window: if it improved by more than ``tol``, another stream
+    is added, if it degraded by more than ``tol``, a stream is retired.
+
+    Parameters
+    ----------
+    fetch
+        Function which downloads the half-open byte range ``[start, end)`` and returns the number of written bytes.
+    ranges
+        Byte ranges to download.
+    n_streams
+        Initial number of concurrent streams.
+    max_streams
+        Maximum number of concurrent streams.
+    window
+        Number of completed ranges after which to reconsider the number of streams.
+    tol
+        Relative change in throughput which triggers an adjustment.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[int, int], int],
+        ranges: Sequence[Tuple[int, int]],
+        n_streams: int = 8,
+        max_streams: int = 16,
+        window: int = 4,
+        tol: float = 0.05,
+    ):
+        self._fetch = fetch
+        self._queue: "Queue[Tuple[int, int]]" = Queue()
+        for rng in ranges:
+            self._queue.put(rng)
+
+        self._max_streams = max(1, max_streams)
+        self._n_streams = max(1, min(n_streams, self._max_streams))
+        self._window = max(1, window)
+        self._tol = tol
+
+        self._cond = Condition()
+        self._active = 0
+        self._written = 0
+        self._error: Optional[BaseException] = None
+
+        self._window_bytes = 0
+        self._window_count = 0
+        self._window_start = perf_counter()
+        self._throughput: Optional[float] = None
+
+    @property
+    def n_streams(self) -> int:
+        """Current target number of concurrent streams."""
+        return self._n_streams
+
+    def run(self) -> int:
+        """
+        Download all ranges.
+
+        Returns
+        -------
+        The total number of written bytes.
+        """
+        with self._cond:
+            self._window_start = perf_counter()
+            self._spawn()
+            try:
+                while self._active:
+                    self._cond.wait()
+            except BaseException as e:
+                self._error = e
+                raise
+
+        if self._error is not None:
+            raise self._error
+
+        return self._written
+
+    def _spawn(self) -> None:
+        # must be called while holding the lock
+        while (
+            self._error is None
+            and self._active < self._n_streams
+            and not self._queue.empty()
+        ):
+            self._active += 1
+            Thread(target=self._work, daemon=True).start()
+
+    def _work(self) -> None:
+        try:
+            while True:
+                with self._cond:
+                    if self._error is not None or self._active > self._n_streams:
+                        return
+                try:
+                    start, end = self._queue.get_nowait()
+                except Empty:
+                    return
+                nbytes = self._fetch(start, end)
+                with self._cond:
+                    self._written += nbytes
+                    self._record(nbytes, perf_counter())
+                    self._spawn()
+        except BaseException as e:  # noqa: B902
+            with self._cond:
+                if self._error is None:
+                    self._error = e
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    def _record(self, nbytes: int, now: float) -> None:
+        # must be called while holding the lock
+        self._window_bytes += nbytes
+        self._window_count += 1
+        if self._window_count < self._window:
+            return
+
+        throughput = self._window_bytes / max(now - self._window_start, 1e-9)
+        prev, n_streams = self._throughput, self._n_streams
+        if prev is None or throughput > prev * (1 + self._tol):
+            # initially, always probe whether an additional stream helps
+            self._n_streams = min(self._n_streams + 1, self._max_streams)
+        elif throughput < prev * (1 - self._tol):
+            self._n_streams = max(self._n_streams - 1, 1)
+
+        if self._n_streams != n_streams:
+            logg.debug(
+                f"Changing number of streams from `{n_streams}` to `{self._n_streams}`, "
+                f"throughput `{throughput / (1 << 20):.2f}` MiB/s"
+            )
+
+        self._throughput = throughput
+        self._window_bytes = 0
+        self._window_count = 0
+        self._window_start = now
+
+
+def _download_parallel(
+    url: str, fpath: Path, n_streams: int = 8, chunk: int = 8 << 20
+) -> bool:
+    """
+    Download a file using concurrent HTTP range requests.
+
+    Parameters
+    ----------
+    url
+        URL to download from.
+    fpath
+        Where to save the file. The data is first written into a temporary file in the same directory
+        which is moved into place only after all ranges have been successfully downloaded. Already downloaded
+        ranges are recorded in a ``.part`` journal next to it, so that an interrupted download can be resumed.
+    n_streams
+        Initial number of concurrent range requests, see :class:`_ConcurrencyController`.
+    chunk
+        Size of a single range request in bytes.
+
+    Returns
+    -------
+    `True` if the file has been downloaded, `False` if the server does not support range requests.
+    """
+    fpath = Path(fpath)
+    tmp = fpath.with_name(fpath.name + ".download")
+    fetch = _RangeFetcher(url, tmp)
+    total = fetch.resolve()
+    if total is None:
+        logg.debug(f"Server for `{url!r}` does not support range requests")
+        return False
+
+    journal = _Journal(fpath.with_name(fpath.name + ".part"), url, total)
+    done = journal.load() if tmp.is_file() and tmp.stat().st_size == total else 0
+    if done:
+        logg.info(
+            f"Resuming download, `{done}/{total}` bytes have already been downloaded"
+        )
+    else:
+        journal.remove()
+        _preallocate(tmp, total)
+
+    ranges = journal.missing(chunk)
+    logg.debug(
+        f"Downloading `{total - done}` bytes in `{len(ranges)}` ranges using initially `{n_streams}` streams"
+    )
+
+    def fetch_with_progress(start: int, end: int) -> int:
+        nbytes = fetch(start, end)
+        journal.add(start, end)
+        pbar.update(nbytes)
+        return nbytes
+
+    try:
+        with _progress_bar(total) as pbar:
+            pbar.update(done)
+            written = _ConcurrencyController(
+                fetch_with_progress, ranges, n_streams=n_streams
+            ).run()
+        if done + written != total:
+            raise OSError(
+                f"Expected to download `{total}` bytes, found `{done + written}`."
+            )
+        os.replace(tmp, fpath)
+        journal.remove()
+    except BaseException:
+        if journal.n_bytes:
+            logg.info(
+                f"Keeping the partially downloaded file `{str(tmp)!r}` to resume the download later"
+            )
+        else:
+            journal.remove()
+            if tmp.is_file():
+                tmp.unlink()
+        raise
+    finally:
+        fetch.close()
+
+    return True
+
+
+def _accept_encoding() -> str:
+    try:
+        import zstandard  # noqa: F401
+
+        return "zstd, gzip"
+    except ImportError:
+        return "gzip"
+
+
+def _decompressor(encoding: str) -> Optional[Any]:
+    encoding = encoding.strip().lower()
+    if encoding in ("", "identity"):
+        return None
+    if encoding == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == "zstd":
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    raise OSError(f"Unsupported content encoding `{encoding}`.")
+
+
+def _download_single(url: str, fpath: Path) -> None:
+    """
+    Download a file using a single HTTP request.
+
+    The response may be compressed using `gzip` or, if :mod:`zstandard` is installed, `zstd`.
+
+    Parameters
+    ----------
+    url
+        URL to download from.
+    fpath
+        Where to save the file.
+
+    Returns
+    -------
+    Nothing, just downloads the file.
+    """
+    fpath = Path(fpath)
+    tmp = fpath.with_name(fpath.name + ".download")
+    req = Request(
+        url, headers={"User-Agent": _USER_AGENT, "Accept-Encoding": _accept_encoding()}
+    )
+    try:
+        with urlopen(req, timeout=_TIMEOUT) as resp, open(tmp, "wb") as fout:
+            total = resp.headers.get("Content-Length", None)
+            decompressor = _decompressor(resp.headers.get("Content-Encoding", ""))
+            received = 0
+            with _progress_bar(None if total is None else int(total)) as pbar:
+                while True:
+                    block = resp.read(_BLOCK_SIZE)
+                    if not block:
+                        break
+                    received += len(block)
+                    pbar.update(len(block))
+                    if decompressor is not None:
+                        block = decompressor.decompress(block)
+                    fout.write(block)
+            if decompressor is not None:
+                fout.write(decompressor.flush())
+        # `Content-Length` is the size of the possibly compressed response
+        if total is not None and received != int(total):
+            raise OSError(f"Expected to download `{total}` bytes, found `{received}`.")
+        os.replace(tmp, fpath)
+    except BaseException:
+        if tmp.is_file():
+            tmp.unlink()
+        raise
+
+
+def _download(url: str, fpath: Path) -> None:
+    """
+    Download a file, preferably using :func:`_download_parallel`.
+
+    Parameters
+    ----------
+    url
+        URL to download from.
+    fpath
+        Where to save the file.
+
+    Returns
+    -------
+    Nothing, just downloads the file.
+    """
+    logg.debug(f"Downloading dataset from `{url!r}` as `{str(fpath)!r}`")
+    # failed ranges are already retried, don't start again using a single stream
+    if not _download_parallel(url, fpath):
+        _download_single(url, fpath)
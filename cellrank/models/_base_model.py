@@ -2,7 +2,7 @@ from typing import Any, Dict, List, Tuple, Union, Mapping, Callable, Optional, S
 
 import re
 import wrapt
-import warnings
+import weakref
 from abc import ABC, ABCMeta, abstractmethod
 from copy import copy as _copy
 from copy import deepcopy
@@ -14,13 +14,13 @@ from cellrank import logging as logg
 from cellrank._utils._docs import d
 from cellrank._utils._enum import ModeEnum
 from cellrank._utils._utils import _minmax, save_fig, valuedispatch, _densify_squeeze
+from cellrank.models._utils import _moving_average, _default_conf_int_stds
 from scanpy.plotting._utils import add_colors_for_categorical_sample_annotation
 from cellrank.kernels.mixins import IOMixin
 from cellrank._utils._lineage import Lineage
 
 import numpy as np
 from scipy.sparse import spmatrix
-from scipy.ndimage import convolve
 from pandas.api.types import infer_dtype
 from pandas.core.dtypes.common import is_numeric_dtype, is_categorical_dtype
 
@@ -35,6 +35,10 @@ __all__ = ["BaseModel"]
 
 _dup_spaces = re.compile(r" +")  # used on repr for underlying model's repr
 ArrayLike = Union[np.ndarray, spmatrix, List, Tuple]
+# `id(adata)` -> (weak reference to `adata`, {(time_key, dtype): (time, unique_time, first_ixs)})
+_time_cache: Dict[
+    int, Tuple[weakref.ref, Dict[Tuple[str, str], Tuple[np.ndarray, ...]]]
+] = {}
 
 
 class UnknownModelError(RuntimeError):
@@ -56,6 +60,53 @@ class ColorType(ModeEnum):
     STR = auto()
 
 
+def _unique_time(
+    adata: AnnData, time_key: str, dtype: np.dtype
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Get the pseudotime and its sorted unique values.
+
+    The result is shared by all models prepared using the same ``adata`` and ``time_key``
+    and is recomputed whenever the values in :attr:`anndata.AnnData.obs` change.
+
+    Parameters
+    ----------
+    adata
+        Annotated data object.
+    time_key
+        Key in :attr:`anndata.AnnData.obs` where the pseudotime is stored.
+    dtype
+        Data type of the pseudotime.
+
+    Returns
+    -------
+    The pseudotime, its sorted unique values and indices of their first occurrences.
+    The arrays must not be modified in place.
+    """
+    x = np.asarray(adata.obs[time_key], dtype=dtype)
+    aid = id(adata)
+
+    entry = _time_cache.get(aid, None)
+    if entry is None or entry[0]() is not adata:
+        entry = _time_cache[aid] = (
+            weakref.ref(adata, lambda _: _time_cache.pop(aid, None)),
+            {},
+        )
+
+    key = (time_key, np.dtype(dtype).str)
+    cached = entry[1].get(key, None)
+    if cached is not None and np.array_equal(cached[0], x, equal_nan=True):
+        return cached
+
+    x = x.copy()  # `np.asarray` might return a view of `adata.obs`
+    x_unique, ixs = np.unique(x, return_index=True)
+    for arr in (x, x_unique, ixs):
+        arr.flags.writeable = False
+    entry[1][key] = x, x_unique, ixs
+
+    return x, x_unique, ixs
+
+
 def _handle_exception(return_type: FailedReturnType, func: Callable) -> Callable:
     def handle(*, exception_handler: Callable):
         @wrapt.decorator
@@ -436,39 +487,33 @@ class BaseModel(IOMixin, ABC, metaclass=BaseModelMeta):
 
         self._obs_names = self.adata.obs_names.values[:]
 
-        x = np.array(self.adata.obs[time_key]).astype(self._dtype)
+        x, x_unique, unique_ixs = _unique_time(self.adata, time_key, self._dtype)
 
-        adata = self.adata.raw.to_adata() if use_raw else self.adata
-        gene_ix = np.where(adata.var_names == gene)[0]
-
-        if data_key in ("X", None):
-            y = adata.X[:, gene_ix]
-            self._data_key = None
-        elif data_key == "obs":
-            y = adata.obs[gene].values
+        if data_key == "obs":
+            y = self.adata.obs[gene].values
             # don't set data_key, it's just when `cell_color = ...`
-        elif data_key in adata.layers:
-            y = adata.layers[data_key][:, gene_ix]
-            self._data_key = data_key
         else:
-            raise NotImplementedError(f"Data key `{data_key!r}` is not implemented.")
+            # `adata.raw` has the same observations, no need to convert it to `AnnData`
+            adata = self.adata.raw if use_raw else self.adata
+            gene_ix = adata.var_names.get_loc(gene)
+            if data_key in ("X", None):
+                y = adata.X[:, gene_ix]
+                self._data_key = None
+            elif data_key in adata.layers:
+                y = adata.layers[data_key][:, gene_ix]
+                self._data_key = data_key
+            else:
+                raise NotImplementedError(
+                    f"Data key `{data_key!r}` is not implemented."
+                )
 
         if lineage is not None:
             weight_threshold, val = weight_threshold
             w = _densify_squeeze(probs.X, self._dtype)
-            w[w < weight_threshold] = val
+            np.putmask(w, w < weight_threshold, val)
         else:
             w = np.ones(len(x), dtype=self._dtype)
 
-        if use_raw:
-            correct_ixs = np.isin(self.adata.obs_names, adata.obs_names)
-            x = x[correct_ixs]
-            y = y[correct_ixs]
-            w = w[correct_ixs]
-            self._obs_names = self._obs_names[correct_ixs]
-
-        del adata
-
         self._x_all, self._y_all, self._w_all = (
             _densify_squeeze(x, self._dtype)[:, np.newaxis],
             _densify_squeeze(y, self._dtype)[:, np.newaxis],
@@ -488,42 +533,42 @@ class BaseModel(IOMixin, ABC, metaclass=BaseModelMeta):
                 f"differs from weights' first dimension ({self._w_all.shape[0]})."
             )
 
-        x, ixs = np.unique(x, return_index=True)  # GAMR (mgcv) needs unique
-        y = y[ixs]
-        w = w[ixs]
-
-        ixs = np.argsort(x)
-        x, y, w = x[ixs], y[ixs], w[ixs]
-        self._obs_names = self._obs_names[ixs]
+        # GAMR (mgcv) needs unique, `x_unique` is already sorted
+        x, y, w = x_unique, y[unique_ixs], w[unique_ixs]
+        self._obs_names = self._obs_names[unique_ixs]
 
         if np.allclose(w, w[0]):
             # degenerate case
             val_start = w[0] - 1
             val_end = w[0] + 1
 
+        # `x` is sorted
+        x_min, x_max = x[0], x[-1]
         if val_start is None:
-            val_start = np.min(x)
+            val_start = x_min
         if val_end is None:
             if threshold is None:
                 threshold = np.nanmedian(w)
             # use `>=` because weights can all be 1
-            w_test = w[w >= threshold]
-            n_window = n_test_points // 20
-            tmp = convolve(w_test, np.ones(n_window) / n_window, mode="nearest")
-            val_end = x[w >= threshold][-1 if lineage is None else np.nanargmax(tmp)]
+            mask = w >= threshold
+            tmp = _moving_average(w[mask], max(1, n_test_points // 20))
+            val_end = x[mask][-1 if lineage is None else np.argmax(tmp)]
 
         if val_start > val_end:
             val_start, val_end = val_end, val_start
-        val_start, val_end = (max(val_start, np.min(x)), min(val_end, np.max(x)))
-
-        fil = (x >= val_start) & (x <= val_end)
+        val_start, val_end = max(val_start, x_min), min(val_end, x_max)
+
+        # `x` is sorted, so the time range is a contiguous block
+        start = np.searchsorted(x, val_start, side="left")
+        end = np.searchsorted(x, val_end, side="right")
+        # `x` is shared between the models, always copy it
+        x, y, w = x[start:end].copy(), y[start:end], w[start:end]
+        self._obs_names = self._obs_names[start:end]
         x_test = (
             np.linspace(val_start, val_end, n_test_points)
             if n_test_points is not None
-            else x[fil]
+            else x.copy()
         )
-        x, y, w = x[fil], y[fil], w[fil]
-        self._obs_names = self._obs_names[fil]
 
         if filter_cells is not None:
             tmp = y.squeeze()
@@ -695,18 +740,13 @@ class BaseModel(IOMixin, ABC, metaclass=BaseModelMeta):
         self._y_hat = self.predict(x_hat, key_added="_x_hat", **kwargs)
         self._y_test = self.predict(x_test, key_added="_x_test", **kwargs)
 
-        n = np.sum(use_ixs)
-        sigma_hat = np.sqrt(
-            ((self.y_hat - self.y[use_ixs].squeeze()) ** 2).sum() / (n - 2)
+        stds = _default_conf_int_stds(
+            np.ravel(self.x).astype(np.float64, copy=False),
+            np.ravel(self.y).astype(np.float64, copy=False),
+            np.ravel(self.w).astype(np.float64, copy=False),
+            np.ravel(self.y_hat).astype(np.float64, copy=False),
+            np.ravel(self.x_test).astype(np.float64, copy=False),
         )
-        mean = np.mean(self.x)
-
-        # fmt: off
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", RuntimeWarning)
-            stds = sigma_hat * np.sqrt(1 + 1 / n + ((self.x_test - mean) ** 2) / ((self.x - mean) ** 2).sum())
-        # fmt: on
-        stds = np.squeeze(stds)
 
         self._conf_int = np.c_[self._y_test - stds / 2.0, self._y_test + stds / 2.0]
 
@@ -1010,7 +1050,8 @@ class BaseModel(IOMixin, ABC, metaclass=BaseModelMeta):
 
         Returns
         -------
-        Array of shape `(n, 1)` with dtype set to :attr:`_dtype`.
+        C-contiguous array of shape `(n, 1)` with dtype set to :attr:`_dtype`.
+        The data is only copied if necessary.
         """
 
         if arr.ndim not in (1, 2):
@@ -1022,7 +1063,7 @@ class BaseModel(IOMixin, ABC, metaclass=BaseModelMeta):
                 f"Expected the 2nd dimension to be 1, found `{arr.shape[1]}.`"
             )
 
-        return np.reshape(arr, (-1, 1)).astype(self._dtype)
+        return np.ascontiguousarray(np.reshape(arr, (-1, 1)), dtype=self._dtype)
 
     def _check(
         self, attr_name: Optional[str], arr: Optional[np.ndarray], ndim: int = 2
@@ -1061,17 +1102,13 @@ class BaseModel(IOMixin, ABC, metaclass=BaseModelMeta):
                 )
             return getattr(self, attr_name)
 
-        setattr(self, attr_name, self._reshape_and_retype(arr))
-        if attr_name.startswith("_"):
-            try:
-                getattr(self, attr_name[1:])
-            except AttributeError:
-                setattr(
-                    self,
-                    attr_name[1:],
-                    property(lambda self: getattr(self, attr_name)),
-                )
-        return getattr(self, attr_name)
+        arr = self._reshape_and_retype(arr)
+        if ndim == 1:
+            # e.g. weights are stored as `(n,)`, not `(n, 1)`
+            arr = arr[:, 0]
+        setattr(self, attr_name, arr)
+
+        return arr
 
     def _deepcopy_attributes(self, dst: "BaseModel") -> None:
         # __deepcopy__ will usually call `_shallowcopy_attributes` twice, since it calls `.copy()`,
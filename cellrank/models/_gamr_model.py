@@ -3,6 +3,7 @@ from typing_extensions import Literal
 
 from copy import copy, deepcopy
 from enum import auto
+from functools import lru_cache
 
 from anndata import AnnData
 from cellrank.models import BaseModel, FailedModel
@@ -90,12 +91,8 @@ class GAMR(BaseModel):
 
         self._control_kwargs = copy(kwargs)
 
-        self._lib = None
-        self._lib_name = None
-
-        # it's a bit costly to import, copying just passes the reference
-        if kwargs.pop("perform_import_check", True):
-            self._lib, self._lib_name = _maybe_import_r_lib("mgcv")
+        # the library is imported only once per process, later calls just return the reference
+        self._lib, self._lib_name = _maybe_import_r_lib("mgcv")
 
         if distribution == "nb" and offset is not None:
             if not isinstance(offset, (np.ndarray, str)):
@@ -147,10 +144,9 @@ class GAMR(BaseModel):
         if isinstance(prepared, FailedModel):
             return prepared
 
-        use_ixs = self.w > 0
-        self._x = self.x[use_ixs]
-        self._y = self.y[use_ixs]
-        self._w = self.w[use_ixs]
+        # compute the indices only once, instead of scanning the mask for each array
+        use_ixs = np.flatnonzero(self.w > 0)
+        self._x, self._y, self._w = self.x[use_ixs], self.y[use_ixs], self.w[use_ixs]
 
         self._design_mat = pd.DataFrame(
             np.c_[self.x, self.y],
@@ -158,8 +154,9 @@ class GAMR(BaseModel):
         )
 
         if self._offset is not None:
-            mask = np.isin(self.adata.obs_names, self._obs_names[use_ixs])
-            self._design_mat["offset"] = self._offset[mask]
+            # the cells are sorted by the pseudotime, not as in `adata`
+            ixs = self.adata.obs_names.get_indexer(self._obs_names[use_ixs])
+            self._design_mat["offset"] = self._offset[ixs]
 
         return self
 
@@ -187,13 +184,13 @@ class GAMR(BaseModel):
             - :attr:`w` - %(base_model_w.summary)s
         """  # noqa
 
-        from rpy2.robjects import Formula, r, pandas2ri
+        from rpy2.robjects import pandas2ri
 
         super().fit(x, y, w, **kwargs)
 
         pandas2ri.activate()
 
-        family = getattr(r, self._family)
+        family = _get_r_object(self._family)
 
         kwargs = {}
         if self._knotslocs != KnotLocs.AUTO:
@@ -207,10 +204,10 @@ class GAMR(BaseModel):
             )
 
         self._model = self._lib.gam(
-            Formula(self._formula),
+            _get_formula(self._formula),
             data=self._design_mat,
             family=family,
-            weights=pd.Series(self.w),
+            weights=self.w,
             control=self._lib.gam_control(**self._control_kwargs),
             **kwargs,
         )
@@ -253,7 +250,6 @@ class GAMR(BaseModel):
         %(base_model_predict.returns)s
         """  # noqa
 
-        from rpy2 import robjects
         from rpy2.robjects import pandas2ri
 
         if self.model is None:
@@ -273,7 +269,7 @@ class GAMR(BaseModel):
         newdata = self._get_x_test(x_test)
 
         pandas2ri.activate()
-        res = robjects.r.predict(
+        res = _get_r_object("predict")(
             self.model,
             newdata=pandas2ri.py2rpy(newdata),
             type="response",
@@ -282,10 +278,10 @@ class GAMR(BaseModel):
         pandas2ri.deactivate()
 
         if level is None:
-            self._y_test = np.array(res).squeeze().astype(self._dtype)
+            self._y_test = np.asarray(res, dtype=self._dtype).reshape(-1)
         else:
-            self._y_test = np.array(res.rx2("fit")).squeeze().astype(self._dtype)
-            se = np.array(res.rx2("se.fit")).squeeze().astype(self._dtype)
+            self._y_test = np.asarray(res.rx2("fit"), dtype=self._dtype).reshape(-1)
+            se = np.asarray(res.rx2("se.fit"), dtype=self._dtype).reshape(-1)
 
             level = norm.ppf(level + (1 - level) / 2)
             self._conf_int = np.c_[self.y_test - level * se, self.y_test + level * se]
@@ -312,7 +308,7 @@ class GAMR(BaseModel):
         %(base_model_ci.returns)s
         """  # noqa
 
-        # this is 2x as fast as opposed to calling `robjects.r.predict` again
+        # this is 2x as fast as opposed to calling R's `predict` again
         # on my PC (Michal):
         #   -`.predict` take ~6.5ms (without se=True, it's ~5.5ms, 20% slowdown)
         #   -`.predict` withouty se=True + `.confidence_interval` take ~12ms
@@ -337,7 +333,6 @@ class GAMR(BaseModel):
             distribution=self._family,
             offset=self._offset,
             knotlocs=self._knotslocs,
-            perform_import_check=False,
         )
         self._shallowcopy_attributes(
             res
@@ -362,6 +357,22 @@ class GAMR(BaseModel):
         self._lib, self._lib_name = _maybe_import_r_lib(self._lib_name, raise_exc=True)
 
 
+@lru_cache(maxsize=None)
+def _get_r_object(name: str) -> Any:
+    # looking up objects, such as the family functions, in R's global environment is not free
+    from rpy2.robjects import r
+
+    return getattr(r, name)
+
+
+@lru_cache(maxsize=None)
+def _get_formula(formula: str) -> Any:
+    # the formula only depends on the model's parameters, not on the data
+    from rpy2.robjects import Formula
+
+    return Formula(formula)
+
+
 def _maybe_import_r_lib(
     name: str, raise_exc: bool = False
 ) -> Tuple[Optional[Any], Optional[str]]:
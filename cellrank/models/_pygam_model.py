@@ -250,7 +250,7 @@ class GAM(BaseModel):
                 message=".* is a deprecated alias for the builtin",
             )
             self._y_test = self.model.predict(x_test, **kwargs)
-        self._y_test = np.squeeze(self._y_test).astype(self._dtype)
+        self._y_test = np.squeeze(self._y_test).astype(self._dtype, copy=False)
 
         return self.y_test
 
@@ -278,7 +278,7 @@ class GAM(BaseModel):
                 message=".* is a deprecated alias for the builtin",
             )
             self._conf_int = self.model.confidence_intervals(x_test, **kwargs).astype(
-                self._dtype
+                self._dtype, copy=False
             )
 
         return self.conf_int
@@ -286,7 +286,9 @@ class GAM(BaseModel):
     @d.dedent
     def copy(self) -> "BaseModel":
         """%(copy)s"""  # noqa
-        res = GAM(self.adata)
+        # don't go through `GAM.__init__`, the model it creates would be immediately replaced
+        res = GAM.__new__(GAM)
+        BaseModel.__init__(res, self.adata, model=None)
         self._shallowcopy_attributes(res)
 
         res._grid = deepcopy(self._grid)
@@ -138,7 +138,7 @@ class SKLearnModel(BaseModel):
         x_test = self._check(key_added, x_test)
 
         self._y_test = self._pred_fn(x_test, **kwargs)
-        self._y_test = np.squeeze(self._y_test).astype(self._dtype)
+        self._y_test = np.squeeze(self._y_test).astype(self._dtype, copy=False)
 
         return self.y_test
 
@@ -113,6 +113,79 @@ def _rankdata(a: np.ndarray, method: str = "average") -> np.ndarray:
     return 0.5 * (count[dense] + count[dense - 1] + 1.0)
 
 
+@njit(cache=True, nogil=True, error_model="numpy")
+def _default_conf_int_stds(
+    x: np.ndarray, y: np.ndarray, w: np.ndarray, y_hat: np.ndarray, x_test: np.ndarray
+) -> np.ndarray:
+    """
+    Compute the standard deviations for :meth:`cellrank.models.BaseModel.default_confidence_interval`.
+
+    Parameters
+    ----------
+    x
+        Independent variables of shape `(n,)`.
+    y
+        Dependent variables of shape `(n,)`.
+    w
+        Weights of shape `(n,)`. Only observations with positive weights are used to estimate the variance.
+    y_hat
+        Predictions for observations with positive weights.
+    x_test
+        Test points of shape `(m,)`.
+
+    Returns
+    -------
+    Array of shape `(m,)` containing the standard deviations at ``x_test``.
+    """
+    mean = 0.0
+    for i in range(x.shape[0]):
+        mean += x[i]
+    mean /= x.shape[0]
+
+    n, rss, ss = 0, 0.0, 0.0
+    for i in range(x.shape[0]):
+        dx = x[i] - mean
+        ss += dx * dx
+        if w[i] > 0:
+            res = y_hat[n] - y[i]
+            rss += res * res
+            n += 1
+
+    sigma_hat = np.sqrt(rss / (n - 2))
+    stds = np.empty(x_test.shape[0], dtype=np.float64)
+    for j in range(x_test.shape[0]):
+        dx = x_test[j] - mean
+        stds[j] = sigma_hat * np.sqrt(1.0 + 1.0 / n + dx * dx / ss)
+
+    return stds
+
+
+def _moving_average(a: np.ndarray, n_window: int) -> np.ndarray:
+    """
+    Compute a moving average, extending the edges by repeating the first and the last value.
+
+    Same as :func:`scipy.ndimage.convolve` with ``weights = np.ones(n_window) / n_window``
+    and ``mode = 'nearest'``, but without the overhead of the n-dimensional filter.
+
+    Parameters
+    ----------
+    a
+        Array of shape `(n,)`.
+    n_window
+        Size of the window.
+
+    Returns
+    -------
+    Array of shape `(n,)`.
+    """
+    n_left = n_window // 2
+    padded = np.concatenate(
+        [np.full(n_window - 1 - n_left, a[0]), a, np.full(n_left, a[-1])]
+    )
+
+    return np.convolve(padded, np.full(n_window, 1.0 / n_window), mode="valid")
+
+
 @inject_docs(m=NormMode)
 def _calculate_norm_factors(
     data: Union[AnnData, np.ndarray, spmatrix],
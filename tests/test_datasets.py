@@ -1,8 +1,218 @@
+import gc
+import os
+import re
 import sys
+import gzip
+import h5py
 import pytest
+import threading
+from types import MappingProxyType
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.error import HTTPError
 
+import scanpy as sc
 import cellrank as cr
-from anndata import AnnData
+from anndata import AnnData, experimental
+from cellrank.datasets._datasets import _Dataset, _is_lazy, _load_dataset_from_url
+from cellrank.datasets._download import (
+    _Journal,
+    _download,
+    _download_parallel,
+    _ConcurrencyController,
+)
+
+import numpy as np
+import pandas as pd
+
+_RANGE = re.compile(r"bytes=(\d+)-(\d+)")
+
+
+def _patch_dataset(mocker, key: str, shape) -> None:
+    datasets = dict(cr.datasets._datasets._datasets)
+    datasets[key] = _Dataset("http://0.0.0.0/", shape)
+    mocker.patch.object(cr.datasets._datasets, "_datasets", MappingProxyType(datasets))
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    data = b""
+    accept_ranges = True
+    compress = False
+    n_failures = 0
+    requests = []
+
+    def do_GET(self) -> None:
+        self.requests.append((self.client_address, self.headers.get("Range", None)))
+        match = _RANGE.fullmatch(self.headers.get("Range", ""))
+        if match is not None and match.group(1) != "0" and self.n_failures > 0:
+            type(self).n_failures -= 1
+            self.send_response(403)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if match is None or not self.accept_ranges:
+            payload = self.data
+            self.send_response(200)
+            if self.compress and "gzip" in self.headers.get("Accept-Encoding", ""):
+                payload = gzip.compress(payload)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        start, end = int(match.group(1)), int(match.group(2))
+        payload = self.data[start : end + 1]
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(self.data)}")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args, **kwargs) -> None:
+        pass
+
+
+@pytest.fixture()
+def server(request):
+    handler = type(
+        "Handler",
+        (_RangeHandler,),
+        {
+            "data": os.urandom(1000),
+            "accept_ranges": getattr(request, "param", True),
+            "requests": [],
+        },
+    )
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{httpd.server_port}/data", handler
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.fixture(scope="module")
+def shared_adata() -> AnnData:
+    # unlike `adata`, this object is not copied for each test and must not be modified
+    return sc.read("tests/_ground_truth_adatas/adata_50.h5ad")
+
+
+@pytest.fixture(scope="module")
+def adata_path(shared_adata: AnnData, tmp_path_factory) -> str:
+    # the tests below only read this file, it's written once per module
+    fpath = tmp_path_factory.mktemp("datasets") / "adata.h5ad"
+    shared_adata.write(fpath, compression="lzf")
+    return str(fpath)
+
+
+class TestDownload:
+    @pytest.mark.parametrize("chunk", [7, 100, 1000, 2048])
+    def test_download_parallel(self, server, tmpdir, chunk: int):
+        url, handler = server
+        fpath = Path(tmpdir) / "data.h5ad"
+
+        assert _download_parallel(url, fpath, n_streams=4, chunk=chunk)
+        assert fpath.read_bytes() == handler.data
+        assert os.listdir(tmpdir) == ["data.h5ad"]
+
+    def test_reuse_connections(self, server, tmpdir):
+        url, handler = server
+        fpath = Path(tmpdir) / "data.h5ad"
+
+        assert _download_parallel(url, fpath, n_streams=4, chunk=10)
+
+        n_requests = len(handler.requests)
+        n_connections = len({addr for addr, _ in handler.requests})
+        assert n_requests == 101
+        # probe + at most `max_streams` persistent connections
+        assert n_connections <= 17
+
+    def test_retry_resolves_url(self, server, tmpdir):
+        url, handler = server
+        handler.n_failures = 2
+        fpath = Path(tmpdir) / "data.h5ad"
+
+        assert _download_parallel(url, fpath, n_streams=1, chunk=100)
+
+        assert fpath.read_bytes() == handler.data
+        # the initial probe and one for each client error
+        assert sum(rng == "bytes=0-0" for _, rng in handler.requests) == 3
+
+    def test_retry_exhausted(self, server, tmpdir):
+        url, handler = server
+        handler.n_failures = 100
+        fpath = Path(tmpdir) / "data.h5ad"
+
+        with pytest.raises(HTTPError):
+            _download_parallel(url, fpath, chunk=100)
+
+        assert not fpath.exists()
+
+    def test_resume(self, server, tmpdir):
+        url, handler = server
+        handler.n_failures = 100
+        fpath = Path(tmpdir) / "data.h5ad"
+        with pytest.raises(HTTPError):
+            _download_parallel(url, fpath, n_streams=1, chunk=100)
+        # the first range never fails
+        assert sorted(os.listdir(tmpdir)) == ["data.h5ad.download", "data.h5ad.part"]
+
+        handler.n_failures = 0
+        handler.requests.clear()
+        assert _download_parallel(url, fpath, n_streams=1, chunk=100)
+
+        assert fpath.read_bytes() == handler.data
+        assert os.listdir(tmpdir) == ["data.h5ad"]
+        ranges = [r for _, r in handler.requests if r != "bytes=0-0"]
+        assert "bytes=0-99" not in ranges
+        assert len(ranges) == 9
+
+    def test_resume_different_url(self, server, tmpdir):
+        url, handler = server
+        fpath = Path(tmpdir) / "data.h5ad"
+        fpath.with_name("data.h5ad.download").write_bytes(bytes(len(handler.data)))
+        _Journal(fpath.with_name("data.h5ad.part"), "foo", len(handler.data)).add(
+            0, 500
+        )
+
+        assert _download_parallel(url, fpath, chunk=100)
+
+        assert fpath.read_bytes() == handler.data
+        assert os.listdir(tmpdir) == ["data.h5ad"]
+
+    @pytest.mark.parametrize("server", [False], indirect=True)
+    def test_no_range_support(self, server, tmpdir):
+        url, _ = server
+        fpath = Path(tmpdir) / "data.h5ad"
+
+        assert not _download_parallel(url, fpath)
+        assert not fpath.exists()
+
+    @pytest.mark.parametrize("server", [False, True], indirect=True)
+    def test_download(self, server, tmpdir):
+        url, handler = server
+        fpath = Path(tmpdir) / "data.h5ad"
+
+        _download(url, fpath)
+
+        assert fpath.read_bytes() == handler.data
+        assert os.listdir(tmpdir) == ["data.h5ad"]
+
+    @pytest.mark.parametrize("server", [False], indirect=True)
+    def test_download_compressed(self, server, tmpdir):
+        url, handler = server
+        handler.compress = True
+        fpath = Path(tmpdir) / "data.h5ad"
+
+        _download(url, fpath)
+
+        assert fpath.read_bytes() == handler.data
+        assert os.listdir(tmpdir) == ["data.h5ad"]
 
 
 @pytest.mark.skipif(
@@ -31,3 +241,328 @@ class TestDataSet:
 
         assert isinstance(adata, AnnData)
         assert adata.shape == (24882, 24051)
+
+
+class TestJournal:
+    def test_missing(self, tmpdir):
+        journal = _Journal(Path(tmpdir) / "foo.part", "foo", 100)
+        for start, end in [(30, 40), (0, 10), (10, 20), (35, 50)]:
+            journal.add(start, end)
+
+        assert journal.n_bytes == 40
+        assert journal.missing(25) == [(20, 30), (50, 75), (75, 100)]
+
+    def test_load(self, tmpdir):
+        fpath = Path(tmpdir) / "foo.part"
+        _Journal(fpath, "foo", 100).add(0, 10)
+
+        assert _Journal(fpath, "foo", 100).load() == 10
+        assert _Journal(fpath, "bar", 100).load() == 0
+        assert _Journal(fpath, "foo", 101).load() == 0
+        fpath.write_text("{")
+        assert _Journal(fpath, "foo", 100).load() == 0
+
+
+class TestConcurrencyController:
+    def test_all_ranges_fetched(self):
+        ranges = [(i, i + 3) for i in range(0, 300, 3)]
+        fetched = []
+
+        def fetch(start: int, end: int) -> int:
+            fetched.append((start, end))
+            return end - start
+
+        ctrl = _ConcurrencyController(fetch, ranges, n_streams=4, window=2)
+
+        assert ctrl.run() == 300
+        assert sorted(fetched) == ranges
+        assert 1 <= ctrl.n_streams <= 16
+
+    def test_error_propagated(self):
+        def fetch(start: int, end: int) -> int:
+            if start == 42:
+                raise OSError("foo")
+            return end - start
+
+        ctrl = _ConcurrencyController(fetch, [(i, i + 1) for i in range(100)])
+
+        with pytest.raises(OSError, match=r"foo"):
+            ctrl.run()
+
+    def test_adjust_streams(self):
+        ctrl = _ConcurrencyController(
+            lambda s, e: e - s, [], n_streams=2, max_streams=3, window=1
+        )
+        ctrl._window_start = 0.0
+
+        # first window always probes an additional stream
+        ctrl._record(100, 1.0)
+        assert ctrl.n_streams == 3
+        # improvement, but already at the maximum
+        ctrl._record(200, 2.0)
+        assert ctrl.n_streams == 3
+        # degradation
+        ctrl._record(100, 3.0)
+        assert ctrl.n_streams == 2
+        # within tolerance
+        ctrl._record(101, 4.0)
+        assert ctrl.n_streams == 2
+
+
+class TestPeekShape:
+    def test_shape_mismatch(self, adata_path: str, mocker):
+        spy = mocker.spy(cr.datasets._datasets, "read")
+
+        with pytest.raises(ValueError, match=r"to have shape `\(1, 1\)`"):
+            _load_dataset_from_url(adata_path, _Dataset("http://0.0.0.0/", (1, 1)))
+        spy.assert_not_called()
+
+    def test_redownload_corrupt(self, shared_adata: AnnData, tmpdir, mocker):
+        fpath = str(tmpdir.join("adata.h5ad"))
+        with open(fpath, "wb") as fout:
+            fout.write(b"foo")
+        download = mocker.patch.object(
+            cr.datasets._datasets,
+            "_download",
+            side_effect=lambda _, fpath: shared_adata.write(fpath),
+        )
+
+        bdata = _load_dataset_from_url(
+            fpath, _Dataset("http://0.0.0.0/", shared_adata.shape)
+        )
+
+        download.assert_called_once_with("http://0.0.0.0/", Path(fpath))
+        assert bdata.shape == shared_adata.shape
+
+
+class TestCache:
+    def test_no_reuse_by_default(self, shared_adata: AnnData, adata_path: str, mocker):
+        cr.datasets.clear_cache()
+        spy = mocker.spy(cr.datasets._datasets, "read")
+
+        adata1 = _load_dataset_from_url(
+            adata_path, _Dataset("http://0.0.0.0/foo", shared_adata.shape)
+        )
+        adata2 = _load_dataset_from_url(
+            adata_path, _Dataset("http://0.0.0.0/foo", shared_adata.shape)
+        )
+
+        assert spy.call_count == 2
+        assert adata1 is not adata2
+        assert len(cr.datasets._datasets._cache) == 0
+
+    def test_reuse(self, shared_adata: AnnData, adata_path: str, mocker):
+        cr.datasets.clear_cache()
+        spy = mocker.spy(cr.datasets._datasets, "read")
+
+        kwargs = {"reuse": True}
+        adata1 = _load_dataset_from_url(
+            adata_path, _Dataset("http://0.0.0.0/", shared_adata.shape), **kwargs
+        )
+        adata2 = _load_dataset_from_url(
+            adata_path, _Dataset("http://0.0.0.0/", shared_adata.shape), **kwargs
+        )
+
+        assert spy.call_count == 1
+        assert adata1 is adata2
+
+        cr.datasets.clear_cache()
+        adata3 = _load_dataset_from_url(
+            adata_path, _Dataset("http://0.0.0.0/", shared_adata.shape), **kwargs
+        )
+
+        assert spy.call_count == 2
+        assert adata3 is not adata1
+
+    def test_reuse_not_referenced(self, shared_adata: AnnData, adata_path: str):
+        cr.datasets.clear_cache()
+
+        bdata = _load_dataset_from_url(
+            adata_path, _Dataset("http://0.0.0.0/", shared_adata.shape), reuse=True
+        )
+        assert len(cr.datasets._datasets._cache) == 1
+
+        del bdata
+        gc.collect()
+
+        assert len(cr.datasets._datasets._cache) == 0
+
+    def test_reuse_public(self, shared_adata: AnnData, adata_path: str, mocker):
+        cr.datasets.clear_cache()
+        _patch_dataset(mocker, "pancreas", shared_adata.shape)
+
+        bdata = cr.datasets.pancreas(path=adata_path, reuse=True)
+
+        assert cr.datasets.pancreas(path=adata_path, reuse=True) is bdata
+        assert cr.datasets.pancreas(path=adata_path) is not bdata
+
+    def test_no_reuse_backed(self, shared_adata: AnnData, adata_path: str, mocker):
+        cr.datasets.clear_cache()
+        spy = mocker.spy(cr.datasets._datasets, "read")
+
+        for _ in range(2):
+            bdata = _load_dataset_from_url(
+                adata_path,
+                _Dataset("http://0.0.0.0/foo", shared_adata.shape),
+                backed="r",
+                reuse=True,
+            )
+            assert bdata.isbacked
+
+        assert spy.call_count == 2
+
+
+class _LazyObs:
+    def __init__(self, obs: pd.DataFrame):
+        self._obs = obs
+
+    def to_memory(self) -> pd.DataFrame:
+        return self._obs.copy()
+
+
+class _LazyAnnData:
+    """Mimics the result of :func:`anndata.experimental.read_lazy`."""
+
+    def __init__(self, fpath: str):
+        adata = sc.read(fpath, backed="r")
+        self.fpath = fpath
+        self.shape = adata.shape
+        self.obs = _LazyObs(adata.obs)
+        self.mask = None
+        adata.file.close()
+
+    def __getitem__(self, mask: np.ndarray) -> "_LazyAnnData":
+        self.mask = mask
+        return self
+
+    def var_names_make_unique(self) -> None:
+        raise AssertionError("Lazy objects should not be modified.")
+
+
+class TestLazy:
+    @pytest.mark.skipif(
+        hasattr(experimental, "read_lazy"),
+        reason="Installed `anndata` supports lazy loading.",
+    )
+    def test_lazy_fallback(self, shared_adata: AnnData, adata_path: str):
+
+        bdata = _load_dataset_from_url(
+            adata_path, _Dataset("http://0.0.0.0/foo", shared_adata.shape), lazy=True
+        )
+
+        assert not _is_lazy(bdata)
+        assert bdata.isbacked
+        assert bdata.shape == shared_adata.shape
+
+    def test_lazy(self, shared_adata: AnnData, adata_path: str, mocker):
+        mocker.patch.object(experimental, "read_lazy", _LazyAnnData, create=True)
+
+        bdata = _load_dataset_from_url(
+            adata_path, _Dataset("http://0.0.0.0/foo", shared_adata.shape), lazy=True
+        )
+
+        assert isinstance(bdata, _LazyAnnData)
+        assert _is_lazy(bdata)
+        assert bdata.fpath == adata_path
+
+    def test_lazy_subset(self, adata: AnnData, tmpdir, mocker):
+        adata.obs["cluster"] = "foo"
+        adata.obs.loc[adata.obs_names[::3], "cluster"] = None
+        fpath = str(tmpdir.join("morris.h5ad"))
+        adata.write(fpath)
+        mocker.patch.object(experimental, "read_lazy", _LazyAnnData, create=True)
+        _patch_dataset(mocker, "reprogramming_morris", adata.shape)
+
+        bdata = cr.datasets.reprogramming_morris("48k", path=fpath, lazy=True)
+
+        assert isinstance(bdata, _LazyAnnData)
+        np.testing.assert_array_equal(bdata.mask, ~adata.obs["cluster"].isnull())
+
+
+class TestReprogrammingMorris:
+    def test_subset_ignores_backed(self, adata: AnnData, tmpdir, mocker):
+        adata.obs["cluster"] = "foo"
+        adata.write(str(tmpdir.join("morris.h5ad")))
+        _patch_dataset(mocker, "reprogramming_morris", adata.shape)
+        spy = mocker.spy(cr.datasets._datasets.logg, "warning")
+
+        bdata = cr.datasets.reprogramming_morris(
+            "48k", path=str(tmpdir.join("morris.h5ad")), backed="r+"
+        )
+
+        assert not bdata.isbacked
+        assert "ignoring `backed='r+'`" in spy.call_args[0][0]
+
+    @pytest.mark.parametrize("backed", [None, "r"])
+    @pytest.mark.parametrize("subset", ["48k", "85k"])
+    def test_local_subset(self, adata: AnnData, tmpdir, mocker, subset: str, backed):
+        key = "cluster" if subset == "48k" else "timecourse"
+        adata.obs[key] = "foo"
+        adata.obs.loc[adata.obs_names[::3], key] = None
+        adata.write(str(tmpdir.join("morris.h5ad")))
+        _patch_dataset(mocker, "reprogramming_morris", adata.shape)
+
+        bdata = cr.datasets.reprogramming_morris(
+            subset, path=str(tmpdir.join("morris.h5ad")), backed=backed
+        )
+
+        assert not bdata.isbacked
+        assert not bdata.is_view
+        np.testing.assert_array_equal(
+            bdata.obs_names, adata.obs_names[~adata.obs[key].isnull()]
+        )
+
+    def test_invalid_subset(self):
+        with pytest.raises(ValueError, match=r"Invalid option `'foo'` for `subset`"):
+            cr.datasets.reprogramming_morris("foo")
+
+
+class TestBacked:
+    @pytest.mark.parametrize(
+        "func,key,backed",
+        [
+            (cr.datasets.lung, "lung", False),
+            (cr.datasets.reprogramming_morris, "reprogramming_morris", True),
+            (cr.datasets.reprogramming_schiebinger, "reprogramming_schiebinger", True),
+        ],
+    )
+    def test_default(
+        self, shared_adata: AnnData, adata_path: str, mocker, func, key: str, backed
+    ):
+        _patch_dataset(mocker, key, shared_adata.shape)
+
+        assert func(path=adata_path).isbacked == backed
+        assert not func(path=adata_path, backed=None).isbacked
+
+    def test_chunk_cache(self, shared_adata: AnnData, adata_path: str):
+
+        bdata = _load_dataset_from_url(
+            adata_path, _Dataset("http://0.0.0.0/", shared_adata.shape), backed="r"
+        )
+
+        _, nslots, nbytes, _ = bdata.file._file.id.get_access_plist().get_cache()
+        assert (nslots, nbytes) == (100003, 128 << 20)
+        np.testing.assert_array_equal(
+            bdata.X[:10].toarray(), shared_adata.X[:10].toarray()
+        )
+        bdata.file.close()
+
+    def test_chunk_cache_fallback(self, shared_adata: AnnData, adata_path: str, mocker):
+        h5py_file = h5py.File
+
+        def open_file(*args, **kwargs):
+            if "rdcc_nbytes" in kwargs:
+                raise OSError("Unable to set the chunk cache.")
+            return h5py_file(*args, **kwargs)
+
+        mocker.patch.object(h5py, "File", side_effect=open_file)
+
+        bdata = _load_dataset_from_url(
+            adata_path, _Dataset("http://0.0.0.0/", shared_adata.shape), backed="r"
+        )
+
+        assert bdata.file.is_open
+        np.testing.assert_array_equal(
+            bdata.X[:10].toarray(), shared_adata.X[:10].toarray()
+        )
+        bdata.file.close()
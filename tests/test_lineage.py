@@ -7,10 +7,23 @@ from html.parser import HTMLParser
 
 from cellrank._utils import Lineage
 from cellrank._utils._colors import _compute_mean_color, _create_categorical_colors
-from cellrank._utils._lineage import _HT_CELLS, LineageView, PrimingDegree
+from cellrank._utils._lineage import (
+    _HT_CELLS,
+    LineageView,
+    PrimingDegree,
+    _js_div,
+    _kl_div,
+    _softmax,
+    _cosine_sim,
+    _mutual_info,
+    _row_normalize,
+    _wasserstein_dist,
+)
 
 import numpy as np
 from pandas import DataFrame
+from scipy.stats import entropy, wasserstein_distance
+from scipy.spatial.distance import jensenshannon
 
 import matplotlib.colors as colors
 
@@ -204,6 +217,26 @@ class TestLineageAccessor:
 
         np.testing.assert_array_equal(y, lineage)
 
+    @pytest.mark.parametrize("rows", [slice(2, 5), [1, 3], 0])
+    def test_rows_keep_names(self, lineage: Lineage, rows):
+        y = lineage[rows]
+        z = y[:, ["baz", "foo"]]
+
+        np.testing.assert_array_equal(y.names, lineage.names)
+        np.testing.assert_array_equal(y.colors, lineage.colors)
+        np.testing.assert_array_equal(z.names, ["baz", "foo"])
+        np.testing.assert_array_equal(z.X, lineage[rows, ["baz", "foo"]].X)
+
+    def test_rows_set_names(self, lineage: Lineage):
+        names, colors = lineage.names.copy(), lineage.colors.copy()
+        y = lineage[:5]
+        y.names = [f"{n}_y" for n in names]
+        y.colors = ["#000000"] * len(colors)
+
+        np.testing.assert_array_equal(lineage.names, names)
+        np.testing.assert_array_equal(lineage.colors, colors)
+        np.testing.assert_array_equal(lineage[:, "foo"].X, lineage.X[:, [0]])
+
     def test_subset_same_instance(self):
         x = np.random.random((10, 3))
         l = Lineage(
@@ -291,6 +324,15 @@ class TestLineageAccessor:
 
         np.testing.assert_array_equal(x[[[0]], [0, 2, 1]], np.array(y))
 
+    def test_remove_duplicates_ints(self):
+        x = np.random.random((10, 3))
+        l = Lineage(x, names=["foo", "bar", "baz"])
+
+        y = l[:, [2, 0, 2, np.int64(0)]]
+
+        np.testing.assert_array_equal(x[:, [2, 0]], np.array(y))
+        np.testing.assert_array_equal(y.names, ["baz", "foo"])
+
     def test_column_invalid_name(self):
         x = np.random.random((10, 3))
         l = Lineage(
@@ -351,6 +393,33 @@ class TestLineageAccessor:
 
         np.testing.assert_array_equal(x[mask, :], np.array(y))
 
+    @pytest.mark.parametrize("rows", [[7, 2, 5], [-1, 0], [3, 3]])
+    def test_comb_row_int_col_mask_order(self, rows):
+        x = np.random.random((10, 3))
+        l = Lineage(x, names=["foo", "bar", "baz"])
+        mask = np.array([True, False, True])
+
+        y = l[rows, mask]
+
+        np.testing.assert_array_equal(np.array(y), x[np.ix_(rows, mask)])
+        np.testing.assert_array_equal(y.names, ["foo", "baz"])
+
+    def test_comb_row_mask_col_int_order(self):
+        x = np.random.random((10, 3))
+        l = Lineage(x, names=["foo", "bar", "baz"])
+        mask = np.arange(10) % 2 == 0
+
+        y = l[mask, [2, 0]]
+
+        np.testing.assert_array_equal(np.array(y), x[mask][:, [2, 0]])
+        np.testing.assert_array_equal(y.names, ["baz", "foo"])
+
+    def test_comb_wrong_mask_length(self):
+        l = Lineage(np.random.random((10, 3)), names=["foo", "bar", "baz"])
+
+        with pytest.raises(IndexError, match=r"wrong length `2`"):
+            _ = l[[0, 1], np.array([True, False])]
+
     def test_column_subset_with_ints(self):
         x = np.random.random((10, 3))
         l = Lineage(
@@ -539,7 +608,7 @@ class TestLineageAccessor:
 
         y = l[["baz", "bar"]]
 
-        assert y._names_to_ixs == {"baz": 0, "bar": 1}
+        assert y._meta.names_to_ixs == {"baz": 0, "bar": 1}
 
     def test_correct_order(self):
         x = np.random.random((10, 3))
@@ -605,7 +674,7 @@ class TestLineageMixing:
     def test_overlap(self):
         x = Lineage(np.random.random((10, 4)), names=["foo", "bar", "baz", "quux"])
 
-        with pytest.raises(ValueError):
+        with pytest.raises(ValueError, match=r"overlapping keys: `\['foo'\]`"):
             _ = x[["foo, bar", "foo"]]
 
     def test_overlap_mix(self):
@@ -625,6 +694,14 @@ class TestLineageMixing:
         np.testing.assert_array_equal(y.names, ["bar, foo"])
         np.testing.assert_array_equal(y.colors, [_compute_mean_color(x.colors[:2])])
 
+    def test_colors_changed(self):
+        x = Lineage(np.random.random((10, 4)), names=["foo", "bar", "baz", "quux"])
+        _ = x[["foo, bar"]]
+        x.colors = ["#ff0000", "#0000ff", "#00ff00", "#000000"]
+        y = x[["foo, bar"]]
+
+        np.testing.assert_array_equal(y.colors, [_compute_mean_color(x.colors[:2])])
+
     def test_row_subset(self):
         x = Lineage(np.random.random((10, 4)), names=["foo", "bar", "baz", "quux"])
         y = x[:5, ["foo, bar"]]
@@ -679,6 +756,28 @@ class TestLineageNormalization:
         assert isinstance(lin, Lineage)
         assert isinstance(weights, DataFrame)
 
+    @pytest.mark.parametrize("dist_measure", ["cosine_sim", "kl_div", "equal"])
+    def test_redistribute_mass(self, lineage: Lineage, dist_measure: str):
+        lin, weights = lineage.reduce(
+            "foo", "bar", dist_measure=dist_measure, return_weights=True
+        )
+        expected = (
+            lineage[:, ["foo", "bar"]].X
+            + lineage[:, list(weights.index)].X @ weights.values
+        )
+
+        np.testing.assert_allclose(lin.X, expected)
+        np.testing.assert_allclose(lin.X.sum(1), 1.0)
+
+    def test_name_is_prefix_of_key(self):
+        X = np.random.random((10, 3))
+        lineage = Lineage(X / X.sum(1, keepdims=True), names=["a", "ab", "c"])
+        lin, weights = lineage.reduce("ab", "c", return_weights=True)
+
+        assert lin.shape == (10, 2)
+        np.testing.assert_array_equal(weights.index, ["a"])
+        np.testing.assert_allclose(lin.X.sum(1), 1.0)
+
     def test_normal_only_1(self, lineage: Lineage):
         lin = lineage.reduce("foo")
 
@@ -798,6 +897,78 @@ class TestLineageNormalization:
             mocker.assert_called_once()
 
 
+class TestPointWiseDistance:
+    @pytest.mark.parametrize(
+        "func,distance",
+        [
+            (_wasserstein_dist, wasserstein_distance),
+            (_kl_div, entropy),
+            (_js_div, jensenshannon),
+        ],
+    )
+    def test_distance(self, func, distance):
+        rng = np.random.default_rng(42)
+        reference, query = rng.uniform(size=(100, 3)), rng.uniform(size=(100, 5))
+        reference_n, query_n = reference / reference.sum(0), query / query.sum(0)
+        expected = np.array(
+            [[1.0 / distance(q, r) for r in reference_n.T] for q in query_n.T]
+        )
+
+        np.testing.assert_allclose(func(reference, query), expected)
+
+    @pytest.mark.parametrize(
+        "func", [_cosine_sim, _wasserstein_dist, _kl_div, _js_div, _mutual_info]
+    )
+    def test_does_not_modify_input(self, func):
+        rng = np.random.default_rng(42)
+        reference, query = rng.uniform(size=(100, 3)), rng.uniform(size=(100, 5))
+        reference[10, 1] = 0
+        reference_orig, query_orig = reference.copy(), query.copy()
+
+        _ = func(reference, query)
+
+        np.testing.assert_array_equal(reference, reference_orig)
+        np.testing.assert_array_equal(query, query_orig)
+
+    def test_zero_rows(self):
+        rng = np.random.default_rng(42)
+        reference, query = rng.uniform(size=(100, 3)), rng.uniform(size=(100, 5))
+        reference[10, 1] = 0
+        query[20, 2] = 0
+        mask = np.ones(100, dtype=bool)
+        mask[[10, 20]] = False
+
+        np.testing.assert_allclose(
+            _kl_div(reference, query), _kl_div(reference[mask], query[mask])
+        )
+
+
+class TestSoftmax:
+    def test_normal_run(self):
+        X = np.random.default_rng(42).normal(size=(10, 5))
+        expected = np.exp(2 * X) / np.exp(2 * X).sum(1, keepdims=True)
+
+        np.testing.assert_allclose(_softmax(X, 2), expected)
+
+    def test_normalize(self):
+        X = np.random.default_rng(42).uniform(size=(10, 5))
+
+        np.testing.assert_allclose(
+            _softmax(X, 2, normalize=True), _softmax(_row_normalize(X), 2)
+        )
+
+    def test_large_values(self):
+        X = np.array([[1000.0, 1000.0], [1000.0, 0.0]])
+
+        np.testing.assert_allclose(_softmax(X), [[0.5, 0.5], [1.0, 0.0]])
+
+    def test_does_not_modify_input(self):
+        X = np.array([[1.0, 2.0], [3.0, 4.0]])
+        _ = _softmax(X)
+
+        np.testing.assert_array_equal(X, [[1.0, 2.0], [3.0, 4.0]])
+
+
 class TestLineageSameLengthIndexing:
     def test_same_names(self):
         x = Lineage(np.random.random((10, 4)), names=["foo", "bar", "baz", "quux"])
@@ -912,6 +1083,12 @@ class TestHTMLRepr:
 
 
 class TestUfuncs:
+    def test_names_index_shared(self, lineage: Lineage):
+        y = lineage * 2
+
+        assert y._meta is lineage._meta
+        np.testing.assert_array_equal(y[:, "bar"].X, lineage[:, "bar"].X * 2)
+
     def test_shape_preserving(self, lineage: Lineage):
         x = np.mean(lineage, axis=0)
         y = np.mean(lineage, axis=1)
@@ -969,7 +1146,7 @@ class TestView:
         assert np.shares_memory(x.X, lineage.X)
         assert np.shares_memory(x.names, lineage.names)
         assert np.shares_memory(x.colors, lineage.colors)
-        assert x._names_to_ixs is lineage._names_to_ixs
+        assert x._meta is lineage._meta
 
     def test_unable_to_set_attributes(self, lineage: Lineage):
         x = lineage.view()
@@ -1002,7 +1179,7 @@ class TestPickling:
         np.testing.assert_array_equal(res.names, lineage.names)
         np.testing.assert_array_equal(res.names, lineage.names)
 
-        assert res._names_to_ixs == lineage._names_to_ixs
+        assert res._meta.names_to_ixs == lineage._meta.names_to_ixs
         assert res._n_lineages == lineage._n_lineages
         assert res._is_transposed == lineage._is_transposed
 
@@ -1023,7 +1200,7 @@ class TestPickling:
         np.testing.assert_array_equal(res.names, lineage.names)
         np.testing.assert_array_equal(res.names, lineage.names)
 
-        assert res._names_to_ixs == lineage._names_to_ixs
+        assert res._meta.names_to_ixs == lineage._meta.names_to_ixs
         assert res._n_lineages == lineage._n_lineages
         assert res._is_transposed == lineage._is_transposed
 
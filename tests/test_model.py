@@ -17,14 +17,17 @@ from cellrank.models._utils import (
     _get_offset,
     _extract_data,
     _get_knotlocs,
+    _moving_average,
+    _default_conf_int_stds,
 )
-from cellrank.models._base_model import FailedModel, UnknownModelError
+from cellrank.models._base_model import FailedModel, UnknownModelError, _time_cache
 from cellrank.models._pygam_model import GamDistribution, GamLinkFunction, _gams
 
 import numpy as np
 from pygam import ExpectileGAM
 from scipy.stats import rankdata
 from sklearn.svm import SVR
+from scipy.ndimage import convolve
 
 
 class TestModel:
@@ -91,6 +94,26 @@ class TestModel:
 
         assert model.conf_int is None
 
+    def test_fit_explicit_data(self, adata_cflare):
+        model = create_model(adata_cflare)
+        model = model.prepare(adata_cflare.var_names[0], "0")
+        x, y, w = model.x.squeeze(), model.y.squeeze(), model.w
+
+        model = model.fit(x, y, w)
+
+        assert model.x.shape == model.y.shape == (len(x), 1)
+        assert model.w.shape == (len(x),)
+        np.testing.assert_array_equal(model.w, w)
+
+    def test_predict_key_added(self, adata_cflare):
+        model = create_model(adata_cflare)
+        model = model.prepare(adata_cflare.var_names[0], "0").fit()
+        x_test = np.linspace(0, 1, 10)
+        _ = model.predict(x_test, key_added="_foo")
+
+        np.testing.assert_array_equal(model._foo, x_test[:, None])
+        assert "foo" not in vars(model)
+
     def test_confidence_interval(self, adata_cflare):
         model = create_model(adata_cflare)
         model = model.prepare(adata_cflare.var_names[0], "0").fit()
@@ -129,6 +152,46 @@ class TestModel:
         assert g.y_hat is None
         assert g.conf_int is None
 
+    def test_reshape_and_retype(self, adata_cflare: AnnData):
+        model = create_model(adata_cflare)
+        arr = np.arange(10, dtype=np.float64)
+
+        res = model._reshape_and_retype(arr)
+        assert res.shape == (10, 1)
+        assert np.shares_memory(res, arr)
+
+        res = model._reshape_and_retype(arr.astype(np.float32)[::2])
+        assert res.shape == (5, 1)
+        assert res.dtype == model._dtype
+        assert res.flags.c_contiguous
+
+    def test_prepare_duplicate_time_obs_names(self, adata_cflare: AnnData):
+        adata_cflare.obs["latent_time"] = np.round(adata_cflare.obs["latent_time"], 1)
+        model = create_model(adata_cflare).prepare(adata_cflare.var_names[0], "0")
+
+        assert len(np.unique(model.x)) == len(model.x) < adata_cflare.n_obs
+        np.testing.assert_array_equal(
+            adata_cflare[model._obs_names].obs["latent_time"], model.x.squeeze()
+        )
+
+    def test_prepare_shares_time(self, adata_cflare: AnnData):
+        m1 = create_model(adata_cflare).prepare(adata_cflare.var_names[0], "0")
+        m2 = create_model(adata_cflare).prepare(adata_cflare.var_names[1], "1")
+        (entry,) = _time_cache[id(adata_cflare)][1].values()
+
+        np.testing.assert_array_equal(m1.x_all.squeeze(), entry[0])
+        np.testing.assert_array_equal(m1.x_all, m2.x_all)
+        assert not entry[0].flags.writeable
+
+    def test_prepare_time_changed(self, adata_cflare: AnnData):
+        gene = adata_cflare.var_names[0]
+        m1 = create_model(adata_cflare).prepare(gene, "0")
+        adata_cflare.obs["latent_time"] = 1 - adata_cflare.obs["latent_time"]
+        m2 = create_model(adata_cflare).prepare(gene, "0")
+
+        np.testing.assert_allclose(m1.x_all, 1 - m2.x_all)
+        np.testing.assert_array_equal(m2.x, np.sort(m2.x, axis=0))
+
 
 class TestUtils:
     def test_extract_data_wrong_type(self):
@@ -179,6 +242,32 @@ class TestUtils:
         with pytest.raises(AssertionError):
             _rankdata(np.random.normal(size=(10,)), method="foobar")
 
+    @pytest.mark.parametrize("n", [1, 3, 50])
+    @pytest.mark.parametrize("n_window", [1, 2, 5, 10])
+    def test_moving_average(self, n: int, n_window: int):
+        a = np.random.RandomState(n).uniform(size=n)
+        expected = convolve(a, np.ones(n_window) / n_window, mode="nearest")
+
+        np.testing.assert_allclose(_moving_average(a, n_window), expected)
+
+    def test_default_conf_int_stds(self):
+        rng = np.random.RandomState(42)
+        x, y, x_test = rng.normal(size=100), rng.normal(size=100), rng.normal(size=20)
+        w = rng.uniform(size=100)
+        w[::3] = 0
+        use_ixs = w > 0
+        y_hat = y[use_ixs] + rng.normal(scale=0.1, size=np.sum(use_ixs))
+
+        n, mean = np.sum(use_ixs), np.mean(x)
+        sigma_hat = np.sqrt(((y_hat - y[use_ixs]) ** 2).sum() / (n - 2))
+        expected = sigma_hat * np.sqrt(
+            1 + 1 / n + (x_test - mean) ** 2 / ((x - mean) ** 2).sum()
+        )
+
+        np.testing.assert_allclose(
+            _default_conf_int_stds(x, y, w, y_hat, x_test), expected
+        )
+
     def test_get_knots_invalid_n_knots(self):
         with pytest.raises(ValueError):
             _get_knotlocs([0, 1, 2], 0)
@@ -350,6 +439,13 @@ class TestGAMR:
         assert g._offset.shape == (adata_cflare.n_obs,)
         assert "offset(offset)" in g._formula
 
+    def test_negative_binomial_offset_aligned(self, adata_cflare: AnnData):
+        g = GAMR(adata_cflare, offset="default", distribution="nb")
+        g = g.prepare(adata_cflare.var_names[0], "0")
+
+        expected = adata_cflare[g._obs_names].obs[_OFFSET_KEY].values
+        np.testing.assert_array_equal(g._design_mat["offset"].values, expected)
+
     def test_negative_binomial_offset_ignored_if_not_nb(self, adata_cflare: AnnData):
         g = GAMR(adata_cflare, offset="default", distribution="gaussian")
 
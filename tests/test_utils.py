@@ -1,9 +1,12 @@
 from typing import Any, Optional
 
+import sys
 import pytest
+import subprocess
 from _helpers import create_model, assert_array_nan_equal, jax_not_installed_skip
 
 import scanpy as sc
+import cellrank as cr
 from anndata import AnnData
 from anndata.utils import make_index_unique
 from cellrank._utils import Lineage
@@ -1051,3 +1054,30 @@ class TestGeneSymbolsCtxManager:
             )
 
         np.testing.assert_array_equal(adata.var_names, adata_orig.var_names)
+
+
+class TestPackage:
+    def test_lazy_submodules(self):
+        code = (
+            "import sys, cellrank as cr; "
+            "assert 'cellrank.pl' not in sys.modules; "
+            "assert 'cellrank._utils._lineage' not in sys.modules; "
+            "pl, lineage = cr.pl, cr.Lineage; "
+            "assert pl is sys.modules['cellrank.pl']; "
+            "assert lineage is sys.modules['cellrank._utils._lineage'].Lineage"
+        )
+        subprocess.run([sys.executable, "-c", code], check=True)
+
+    def test_unknown_attribute(self):
+        with pytest.raises(AttributeError, match="has no attribute 'foo'"):
+            _ = cr.foo
+
+    def test_dir(self):
+        names = dir(cr)
+
+        assert {"pl", "Lineage", "settings", "__full_version__"} <= set(names)
+        assert not {"Any", "List", "TYPE_CHECKING", "lru_cache"} & set(names)
+
+    def test_full_version(self):
+        assert cr.__full_version__.startswith(cr.__version__)
+        assert cr.__full_version__ is cr.__full_version__